@@ -0,0 +1,294 @@
+"""Times each stage of `make_picaso_db.py` and `make_photochem_ktable.py` on
+synthetic HELIOS-K outputs, and writes the throughput and peak RSS of every
+stage as JSON. Each stage runs in a fresh process, so its peak RSS is not
+inflated by the stages before it.
+
+    python benchmarks/bench_postprocess.py --nspecies 2 --nT 4 --nnu 2000 --output bench.json
+
+With the defaults, the synthetic data is about 100 MB and the whole suite runs
+in a few minutes on a laptop.
+"""
+import numpy as np
+import os
+import sys
+import json
+import time
+import resource
+import contextlib
+import argparse
+import tempfile
+import h5py
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from wogan_data import bins as wogan_bins
+from wogan_data import grids as wogan_grids
+from wogan_data import manifest as wogan_manifest
+
+def species_names(nspecies):
+    return ['SP%i'%i for i in range(nspecies)]
+
+def write_synthetic_data(outdir, nspecies, nT, nnu, nbins, seed=0):
+    """Writes synthetic HELIOS-K outputs and Photochem data to `outdir`.
+
+    Creates, for each species, `Out_<sp>.bin` (full spectra on the grid of
+    `wogan_grids.heliosk_wavenumbers(nnu)`), a manifest and `nbins` k-distribution
+    files `Out_<sp>_bin####.dat`. Also creates `data/CIA/*.h5` and photolysis
+    cross sections in `data/xsections/`.
+
+    Returns
+    -------
+    dict
+        Sizes of the synthetic data.
+    """
+    rng = np.random.default_rng(seed)
+    T = wogan_bins.T_grid[1:nT+1]
+    P = wogan_bins.P_grid
+    wno = wogan_grids.heliosk_wavenumbers(nnu)
+
+    for sp in species_names(nspecies):
+        # Full spectra, written one temperature at a time like HELIOS-K
+        with open(os.path.join(outdir, 'Out_'+sp+'.bin'), 'wb') as f:
+            for i in range(len(T)):
+                log10k = rng.uniform(-30, -18, size=(len(P), len(wno)))
+                (10.0**log10k).astype(np.float32).tofile(f)
+        manifest = {
+            'species': sp, 'param_file': None,
+            'params': {key: None for key in wogan_manifest.PARAM_KEYS},
+            'P': list(P), 'T': list(T), 'timings': [],
+        }
+        wogan_manifest.write_manifest(outdir, sp, manifest)
+
+        # k-distributions: weights, k, T, P (atm), g-point index
+        edges = wogan_bins.weights_to_bins(wogan_bins.weights)
+        g = (edges[1:] + edges[:-1])/2
+        Tg, Pg, ig = np.meshgrid(T, wogan_bins.P_grid_atm, np.arange(len(g)), indexing='ij')
+        for l in range(nbins):
+            xs = 10.0**rng.uniform(-30, -18, size=Tg.size)
+            table = np.stack((g[ig.ravel()], xs, Tg.ravel(), Pg.ravel(), ig.ravel()), axis=1)
+            np.savetxt(os.path.join(outdir, 'Out_'+sp+'_bin'+str(l).rjust(4,'0')+'.dat'), table,
+                       fmt=['%.17e', '%.8e', '%.4f', '%.8e', '%i'])
+
+    # CIA tables and photolysis cross sections
+    for name in ['cia_data', 'data']:
+        os.makedirs(os.path.join(outdir, name, 'CIA'))
+        for pair in ['N2-N2', 'CO2-CO2', 'H2-H2']:
+            with h5py.File(os.path.join(outdir, name, 'CIA', pair+'.h5'), 'w') as f:
+                f['T'] = np.linspace(100, 1000, 10)
+                f['wavelengths'] = np.logspace(0, 2, 500)
+                f['log10xs'] = rng.uniform(-50, -40, size=(500, 10))
+    os.makedirs(os.path.join(outdir, 'data', 'xsections'))
+    for sp in species_names(nspecies):
+        with h5py.File(os.path.join(outdir, 'data', 'xsections', sp+'.h5'), 'w') as f:
+            f['wavelengths'] = np.linspace(100, 300, 2000)
+            f['photoabsorption'] = 10.0**rng.uniform(-20, -17, size=2000)
+
+    return {'nspecies': nspecies, 'nT': len(T), 'nP': len(P), 'nwno': len(wno), 'nbins': nbins,
+            'out_bin_bytes': nspecies*len(T)*len(P)*len(wno)*4}
+
+def _peak_rss_mb():
+    # ru_maxrss is in kB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss/1024**2 if sys.platform == 'darwin' else rss/1024
+
+def _targets(config):
+    return [tuple(a) for a in config['targets']]
+
+def _operators(config, wno):
+    import make_picaso_db
+    grids, operators = [], []
+    for min_wavelength, max_wavelength, new_R in _targets(config):
+        grid, bins = make_picaso_db.resampled_grid(min_wavelength, max_wavelength, new_R, config['old_R'])
+        grids.append(grid)
+        operators.append(make_picaso_db.ResamplingOperator.build(wno, grid, config['method'], nsub=bins))
+    return grids, operators
+
+def stage_read(outdir, config):
+    import make_picaso_db
+    nwno = config['nwno']
+    nbytes = 0
+    for sp in species_names(config['nspecies']):
+        T, k = make_picaso_db.read_heliosk_output(outdir, sp, nwno)
+        for i in range(len(T)):
+            np.asarray(k[i]).sum()
+        nbytes += k.nbytes
+    return {'items': nbytes//4, 'unit': 'values', 'bytes_read': nbytes}
+
+def stage_operator_build(outdir, config):
+    wno = wogan_grids.heliosk_wavenumbers(config['nnu'])
+    _, operators = _operators(config, wno)
+    return {'items': len(operators), 'unit': 'operators'}
+
+def stage_resample(outdir, config):
+    import make_picaso_db
+    wno = wogan_grids.heliosk_wavenumbers(config['nnu'])
+    _, operators = _operators(config, wno)
+    nspectra = 0
+    t0 = time.perf_counter()
+    for sp in species_names(config['nspecies']):
+        T, k = make_picaso_db.read_heliosk_output(outdir, sp, len(wno))
+        for i in range(len(T)):
+            slab = np.asarray(k[i])
+            for op in operators:
+                op.apply(slab)
+                nspectra += slab.shape[0]
+    return {'items': nspectra, 'unit': 'spectra', 'seconds': time.perf_counter() - t0}
+
+def _insert(outdir, config, data_dir):
+    import make_picaso_db
+    wno = wogan_grids.heliosk_wavenumbers(config['nnu'])
+    grids, operators = _operators(config, wno)
+    dbs = [os.path.join(outdir, 'bench_%s_%i.db'%(os.path.basename(data_dir), m)) for m in range(len(grids))]
+    nrows = 0
+    t0 = time.perf_counter()
+    for db in dbs:
+        if os.path.exists(db):
+            os.remove(db)
+        make_picaso_db.build_skeleton(db)
+    for sp in species_names(config['nspecies']):
+        T, k = make_picaso_db.read_heliosk_output(outdir, sp, len(wno))
+        make_picaso_db.insert_molecule_targets(
+            list(zip(dbs, grids, operators)), sp, data_dir, T, wogan_bins.P_grid, k,
+            codec=config['codec'], verbose=False
+        )
+        nrows += len(T)*len(wogan_bins.P_grid)*len(dbs)
+    seconds = time.perf_counter() - t0
+    nbytes = sum(os.path.getsize(db) for db in dbs)
+    for db in dbs:
+        os.remove(db)
+    return {'items': nrows, 'unit': 'rows', 'seconds': seconds, 'bytes_written': nbytes}
+
+def stage_insert(outdir, config):
+    # 'cia_data' has no photolysis cross sections
+    return _insert(outdir, config, os.path.join(outdir, 'cia_data'))
+
+def stage_insert_photolysis(outdir, config):
+    return _insert(outdir, config, os.path.join(outdir, 'data'))
+
+def stage_sqlite_insert(outdir, config):
+    import make_picaso_db
+    wno = wogan_grids.heliosk_wavenumbers(config['nnu'])
+    grids, _ = _operators(config, wno)
+    spectrum = np.random.default_rng(0).random(len(grids[0]))
+    nrows = config['nspecies']*config['nT']*len(wogan_bins.P_grid)
+    db = os.path.join(outdir, 'bench_sqlite.db')
+    if os.path.exists(db):
+        os.remove(db)
+    make_picaso_db.build_skeleton(db)
+    t0 = time.perf_counter()
+    with make_picaso_db.DBWriter(db, codec=config['codec']) as writer:
+        for i in range(nrows):
+            writer.add_molecular(i, 'SP', 300.0, 1.0, spectrum)
+    make_picaso_db.create_indexes(db)
+    seconds = time.perf_counter() - t0
+    nbytes = os.path.getsize(db)
+    os.remove(db)
+    return {'items': nrows, 'unit': 'rows', 'seconds': seconds, 'bytes_written': nbytes}
+
+def stage_hdf5_export(outdir, config):
+    import make_picaso_db
+    nbytes = 0
+    for sp in species_names(config['nspecies']):
+        filename = os.path.join(outdir, sp+'.h5')
+        make_picaso_db.resave_molecule_h5(outdir, sp, filename, config['nwno'])
+        nbytes += os.path.getsize(filename)
+        os.remove(filename)
+    return {'items': config['nspecies']*config['nT']*len(wogan_bins.P_grid), 'unit': 'spectra', 'bytes_written': nbytes}
+
+def stage_continuum(outdir, config):
+    import make_picaso_db
+    wno = wogan_grids.heliosk_wavenumbers(config['nnu'])
+    grids, _ = _operators(config, wno)
+    data_dir = os.path.join(outdir, 'data')
+    db = os.path.join(outdir, 'bench_continuum.db')
+    make_picaso_db.build_skeleton(db)
+    cia_data = make_picaso_db.read_CIA_data(data_dir)
+    for grid in grids:
+        make_picaso_db.insert_continuum(db, data_dir, grid, cia_data, codec=config['codec'])
+    os.remove(db)
+    return {'items': len(grids)*len(cia_data[0])*len(cia_data[3]), 'unit': 'rows'}
+
+def stage_ktable_parse(outdir, config):
+    import make_photochem_ktable
+    nbytes = 0
+    for sp in species_names(config['nspecies']):
+        make_photochem_ktable.read_helios_results(outdir, sp, config['nbins'])
+        for l in range(config['nbins']):
+            nbytes += os.path.getsize(os.path.join(outdir, 'Out_'+sp+'_bin'+str(l).rjust(4,'0')+'.dat'))
+    return {'items': config['nspecies']*config['nbins'], 'unit': 'bin files', 'bytes_read': nbytes}
+
+STAGES = {
+    'read': stage_read,
+    'operator_build': stage_operator_build,
+    'resample': stage_resample,
+    'insert': stage_insert,
+    'insert_photolysis': stage_insert_photolysis,
+    'sqlite_insert': stage_sqlite_insert,
+    'hdf5_export': stage_hdf5_export,
+    'continuum': stage_continuum,
+    'ktable_parse': stage_ktable_parse,
+}
+
+def run_stage(name, outdir, config):
+    """Runs one stage and returns its timings. Called in a fresh process."""
+    cpu0 = time.process_time()
+    t0 = time.perf_counter()
+    # Progress messages of the scripts would corrupt JSON written to stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        result = STAGES[name](outdir, config)
+    result.setdefault('seconds', time.perf_counter() - t0)
+    result['cpu_seconds'] = time.process_time() - cpu0
+    result['throughput'] = result['items']/result['seconds']
+    for key in ['bytes_read', 'bytes_written']:
+        if key in result:
+            result[key.replace('bytes', 'MB_per_s')] = result[key]/1024**2/result['seconds']
+    result['peak_rss_mb'] = _peak_rss_mb()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nspecies', type=int, default=2, help='Number of synthetic species')
+    parser.add_argument('--nT', type=int, default=4, help='Number of temperatures')
+    parser.add_argument('--nnu', type=int, default=2000, help='Wavenumbers per bin (HELIOS-K "Nnu per bin")')
+    parser.add_argument('--nbins', type=int, default=len(wogan_bins.wavnum)-1, help='Number of k-distribution bin files')
+    parser.add_argument('--targets', default='0.1,250,15000',
+                        help='Semicolon separated min_wavelength,max_wavelength,R targets')
+    parser.add_argument('--old-R', type=float, default=1e5, help='Resolution of the intermediate grid')
+    parser.add_argument('--method', default='point', help='Resampling method')
+    parser.add_argument('--codec', default='npy', help='Blob codec')
+    parser.add_argument('--stages', default=','.join(STAGES), help='Comma separated stages to run')
+    parser.add_argument('--workdir', default=None, help='Directory for the synthetic data (default: a temporary directory)')
+    parser.add_argument('--output', default=None, help='JSON output file (default: stdout)')
+    args = parser.parse_args()
+
+    config = {
+        'nspecies': args.nspecies, 'nT': args.nT, 'nnu': args.nnu, 'nbins': args.nbins,
+        'targets': [[float(b) for b in a.split(',')] for a in args.targets.split(';')],
+        'old_R': args.old_R, 'method': args.method, 'codec': args.codec,
+    }
+    stages = args.stages.split(',')
+    for name in stages:
+        if name not in STAGES:
+            parser.error('Unknown stage '+name+'. Options are '+', '.join(STAGES))
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as outdir:
+        t0 = time.perf_counter()
+        config.update(write_synthetic_data(outdir, args.nspecies, args.nT, args.nnu, args.nbins))
+        report = {'config': config, 'setup_seconds': time.perf_counter() - t0, 'stages': {}}
+
+        ctx = multiprocessing.get_context('spawn')
+        for name in stages:
+            print('Running '+name, file=sys.stderr)
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                report['stages'][name] = pool.submit(run_stage, name, outdir, config).result()
+
+    out = json.dumps(report, indent=2)
+    if args.output is None:
+        print(out)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(out+'\n')
+
+if __name__ == '__main__':
+    main()
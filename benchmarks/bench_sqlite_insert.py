@@ -0,0 +1,70 @@
+"""Compares the old row-by-row INSERTs into a PICASO opacity DB with the
+batched `DBWriter`, and times indexed lookups of one molecule.
+
+    python benchmarks/bench_sqlite_insert.py --nrows 2000 --nwno 100000
+"""
+import numpy as np
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import make_picaso_db
+
+def insert_row_by_row(db_f, rows):
+    cur, conn = make_picaso_db.open_local(db_f)
+    for row in rows:
+        cur.execute('INSERT INTO molecular (ptid, molecule, temperature, pressure,opacity) values (?,?,?,?,?)', row)
+    conn.commit()
+    conn.close()
+
+def insert_with_writer(db_f, rows):
+    with make_picaso_db.DBWriter(db_f) as writer:
+        for row in rows:
+            writer.add_molecular(*row)
+
+def time_lookup(db_f, molecule, nrepeat=20):
+    cur, conn = make_picaso_db.open_local(db_f)
+    t0 = time.perf_counter()
+    for _ in range(nrepeat):
+        cur.execute('SELECT ptid, opacity FROM molecular WHERE molecule = ? ORDER BY ptid', (molecule,))
+        cur.fetchall()
+    dt = (time.perf_counter() - t0)/nrepeat
+    conn.close()
+    return dt
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nrows', type=int, default=2000, help='Number of (T, P, molecule) rows')
+    parser.add_argument('--nwno', type=int, default=100_000, help='Number of wavenumbers per row')
+    parser.add_argument('--nmolecules', type=int, default=10, help='Number of molecules the rows are split between')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    spectrum = rng.random(args.nwno)
+    nper = args.nrows//args.nmolecules
+    rows = [(i % nper, 'M%i'%(i//nper), 300.0, 1.0, spectrum) for i in range(args.nrows)]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        results = {}
+        for name, fcn in [('row_by_row', insert_row_by_row), ('DBWriter', insert_with_writer)]:
+            db_f = os.path.join(tmpdir, name+'.db')
+            make_picaso_db.build_skeleton(db_f)
+            t0 = time.perf_counter()
+            fcn(db_f, rows)
+            dt = time.perf_counter() - t0
+            results[name] = db_f
+            print('%-12s %10.1f rows/s'%(name, args.nrows/dt))
+
+        molecule = 'M%i'%(args.nmolecules//2)
+        db_f = results['DBWriter']
+        dt = time_lookup(db_f, molecule)
+        print('%-12s %10.4f s per molecule'%('no index', dt))
+        make_picaso_db.create_indexes(db_f)
+        dt = time_lookup(db_f, molecule)
+        print('%-12s %10.4f s per molecule'%('indexed', dt))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""Per-stage timing and memory instrumentation for the post-processing scripts.
+
+When enabled, every `stage` appends one JSON line to a log file with its wall
+time, CPU time, bytes read and written, and peak memory:
+
+    {"stage": "insert_molecule", "molecule": "H2O", "pid": 1234, "wall_seconds": 12.3, ...}
+
+Instrumentation is enabled with the environment variable
+`PHOTOCHEM_INSTRUMENT=<log file>`, or with `enable(<log file>)` (which the
+`--instrument` flag of the scripts calls). Worker processes inherit the setting
+and append to the same file. When it is not enabled, `stage` does nothing.
+
+Bytes read and written come from /proc/self/io, and peak memory from VmHWM in
+/proc/self/status, which is reset at the start of each stage. On systems
+without /proc, bytes are not recorded and peak memory is the peak of the
+whole process.
+"""
+import os
+import sys
+import json
+import time
+import resource
+import contextlib
+import functools
+
+ENV_VAR = 'PHOTOCHEM_INSTRUMENT'
+
+# Peak RSS seen by each open stage before an inner stage reset it
+_open_stages = []
+
+def enable(filename):
+    """Enables instrumentation, appending to `filename`. Also sets the
+    environment variable, so worker processes log too."""
+    os.environ[ENV_VAR] = os.path.abspath(filename)
+
+def disable():
+    os.environ.pop(ENV_VAR, None)
+
+def log_filename():
+    """The log file, or None if instrumentation is disabled."""
+    filename = os.environ.get(ENV_VAR)
+    return filename if filename else None
+
+def _read_proc(filename):
+    values = {}
+    try:
+        with open(filename, 'r') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                values[key.strip()] = value.strip()
+    except OSError:
+        pass
+    return values
+
+def _io_counters():
+    io = _read_proc('/proc/self/io')
+    keys = ['rchar', 'wchar', 'read_bytes', 'write_bytes']
+    if not all(key in io for key in keys):
+        return None
+    return [int(io[key]) for key in keys]
+
+def _peak_rss_mb():
+    status = _read_proc('/proc/self/status')
+    if 'VmHWM' in status:
+        return int(status['VmHWM'].split()[0])/1024
+    # ru_maxrss is in kB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss/1024**2 if sys.platform == 'darwin' else rss/1024
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def write_record(record):
+    """Appends a record to the log as one JSON line."""
+    filename = log_filename()
+    if filename is None:
+        return
+    line = json.dumps(record)+'\n'
+    # One write in append mode, so that lines from several processes do not interleave
+    with open(filename, 'a') as f:
+        f.write(line)
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """Records the resources used inside a `with` block.
+
+    Parameters
+    ----------
+    name : str
+        Stage name
+    **fields
+        Added to the record, e.g. molecule='H2O'.
+
+    Yields
+    ------
+    dict
+        The record. Items can be added to it inside the block, e.g. the number
+        of rows written.
+    """
+    record = {'stage': name}
+    record.update(fields)
+    if log_filename() is None:
+        yield record
+        return
+
+    # Save the peak of the enclosing stages before resetting it
+    peak = _peak_rss_mb()
+    for i in range(len(_open_stages)):
+        _open_stages[i] = max(_open_stages[i], peak)
+    _reset_peak_rss()
+    _open_stages.append(0.0)
+
+    io0 = _io_counters()
+    cpu0 = time.process_time()
+    t0 = time.perf_counter()
+    record['pid'] = os.getpid()
+    record['start'] = time.time()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = repr(e)
+        raise
+    finally:
+        record['wall_seconds'] = time.perf_counter() - t0
+        record['cpu_seconds'] = time.process_time() - cpu0
+        io1 = _io_counters()
+        if io0 is not None and io1 is not None:
+            record['bytes_read'] = io1[0] - io0[0]
+            record['bytes_written'] = io1[1] - io0[1]
+            record['disk_bytes_read'] = io1[2] - io0[2]
+            record['disk_bytes_written'] = io1[3] - io0[3]
+        record['peak_rss_mb'] = max(_open_stages.pop(), _peak_rss_mb())
+        for i in range(len(_open_stages)):
+            _open_stages[i] = max(_open_stages[i], record['peak_rss_mb'])
+        write_record(record)
+
+def instrumented(name):
+    """Decorator that runs a whole function as a `stage`."""
+    def decorator(fcn):
+        @functools.wraps(fcn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fcn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def add_argument(parser):
+    """Adds the `--instrument` flag to an argparse parser."""
+    parser.add_argument('--instrument', metavar='LOG', default=None,
+                        help='Append per-stage timing and memory records to LOG as JSON lines '
+                             '(same as setting %s=LOG)'%ENV_VAR)
+
+def setup(args):
+    """Enables instrumentation if `--instrument` was given."""
+    if args.instrument is not None:
+        enable(args.instrument)
@@ -1,89 +1,261 @@
 import numpy as np
-from matplotlib import pyplot as plt
 import h5py
 import os
-import numba as nb
-from numba import types
+import contextlib
+import concurrent.futures
+from multiprocessing import shared_memory
 from wogan_data import bins as wogan_bins
+from wogan_data import grids as wogan_grids
+from wogan_data import manifest as wogan_manifest
+import instrument
+import parallel
+
+# Columns of the HELIOS-K k-distribution files `Out_<sp>_bin####.dat`:
+# g-point, cross section, T (K), P (atm) and g-point index
+BIN_FILE_DTYPE = np.dtype([
+    ('weights', np.float64), ('xs', np.float64), ('T', np.float64), ('P', np.float64), ('weightsn', np.float64)
+])
+
+def read_bin_file(filename):
+    """Reads a HELIOS-K k-distribution file into a structured array with the
+    fields of `BIN_FILE_DTYPE`. Duplicate lines are removed, keeping the first
+    occurrence of each in order, and P is converted to bar."""
+    data = np.loadtxt(filename, dtype=BIN_FILE_DTYPE, ndmin=1)
+    # Compare whole lines as raw bytes, which is faster than field by field
+    _, ind = np.unique(data.view(np.dtype((np.void, data.itemsize))), return_index=True)
+    data = data[np.sort(ind)]
+    # atm * (1.01325 bar / 1 atm)
+    data['P'] *= (1.01325/1)
+    return data
 
-# @nb.njit()
-def remove_duplicates(seq):
-    seen = set()
-    seen_add = seen.add
-    return [x for x in seq if not (x in seen or seen_add(x))]
-
-@nb.experimental.jitclass()
-class KFile():
-    weights : types.double[:]
-    xs: types.double[:]
-    T : types.double[:]
-    P : types.double[:]
-    weightsn : types.int32[:]
-    def __init__(self, n):
-        self.weights = np.empty(n)
-        self.xs = np.empty(n)
-        self.T = np.empty(n)
-        self.P = np.empty(n)
-        self.weightsn = np.empty(n,np.int32)
-
-@nb.experimental.jitclass()
 class KGrid():
-    g : types.double[:]
-    ng : types.int32[:]
-    P : types.double[:]
-    T : types.double[:]
-    def __init__(self, k):
-        self.g = np.unique(k.weights)
-        self.ng = np.unique(k.weightsn)
-        self.P = np.unique(k.P)
-        self.T = np.unique(k.T)
-
-@nb.njit()
-def helper(k, g, i):
-    iT = np.argmin(np.abs(k.T[i]-g.T))
-    assert np.isclose(k.T[i],g.T[iT],rtol=1e-8,atol=1e-20)
-
-    iP = np.argmin(np.abs(k.P[i]-g.P))
-    assert np.isclose(k.P[i],g.P[iP],rtol=1e-8,atol=1e-20)
-
-    ig = np.argmin(np.abs(k.weightsn[i]-g.ng))
-    assert np.isclose(k.weightsn[i],g.ng[ig],rtol=1e-8,atol=1e-20)
-    return iT, iP, ig
-
-# @nb.njit()
-def read_helios_results(folder, sp, nw):
+    """The g-points, g-point indices, pressures and temperatures in a
+    k-distribution file (see `read_bin_file`)."""
+    def __init__(self, data):
+        self.g = np.unique(data['weights'])
+        self.ng = np.unique(data['weightsn'].astype(np.int32))
+        self.P = np.unique(data['P'])
+        self.T = np.unique(data['T'])
+
+def grid_indices(values, grid, name, rtol=1e-8, atol=1e-20):
+    """Indices of the nearest points of a sorted grid to each of `values`.
+    Raises an AssertionError if any value is not on the grid (see `np.isclose`).
+    """
+    if len(grid) == 1:
+        ind = np.zeros(len(values), np.intp)
+    else:
+        ind = np.clip(np.searchsorted(grid, values), 1, len(grid)-1)
+        # Ties go to the lower point, like np.argmin
+        ind -= np.abs(values - grid[ind-1]) <= np.abs(values - grid[ind])
+    close = np.isclose(values, grid[ind], rtol=rtol, atol=atol)
+    assert np.all(close), name+' values are not on the grid: '+str(np.unique(values[~close]))
+    return ind
+
+def scatter_bin(kcoeff, g, data, l):
+    """Puts the cross sections of a k-distribution file for bin `l` into
+    `kcoeff[:,:,:,l]`. Where a (g, P, T) point appears more than once, the last
+    value is used."""
+    iT = grid_indices(data['T'], g.T, 'T')
+    iP = grid_indices(data['P'], g.P, 'P')
+    ig = grid_indices(data['weightsn'].astype(np.int32), g.ng, 'g-point index')
+    flat = np.ravel_multi_index((ig, iP, iT), kcoeff.shape[:3])
+    _, last = np.unique(flat[::-1], return_index=True)
+    last = len(flat) - 1 - last
+    kcoeff[ig[last],iP[last],iT[last],l] = data['xs'][last]
+
+def bin_filename(folder, sp, l):
+    return folder+'/Out_'+sp+'_bin'+str(l).rjust(4,'0')+'.dat'
+
+# Number of bins read by each task of `submit_helios_results`
+BINS_PER_TASK = 8
+
+def _scatter_bin_files(shm_name, shape, g, folder, sp, bins):
+    """Worker for `submit_helios_results`, which puts several bins into the shared `kcoeff`."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        kcoeff = np.ndarray(shape, np.float64, buffer=shm.buf, order='F')
+        nw = shape[-1]
+        for l in bins:
+            scatter_bin(kcoeff, g, read_bin_file(bin_filename(folder, sp, l)), nw-l-1)
+        del kcoeff
+    finally:
+        shm.close()
+
+class PendingResults():
+    """The `read_helios_results` of a species, which are being read by the
+    workers of a process pool into a `kcoeff` array in shared memory.
+    Call `result` to get them."""
+    def __init__(self, g, shm, shape, futures):
+        self.g = g
+        self.shm = shm
+        self.shape = shape
+        self.futures = futures
+
+    def result(self):
+        """Waits for all bins, and returns the same as `read_helios_results`."""
+        try:
+            # Every task must be done with the shared memory before it is removed
+            concurrent.futures.wait(self.futures)
+            for future in self.futures:
+                future.result()
+            kcoeff = np.ndarray(self.shape, np.float64, buffer=self.shm.buf, order='F')
+            kcoeff = np.array(kcoeff, order='F')
+        finally:
+            self.shm.close()
+            self.shm.unlink()
+        assert np.all(np.min(kcoeff) >= 0)
+        return self.g.g, self.g.P, self.g.T, kcoeff
+
+def submit_helios_results(pool, folder, sp, nw):
+    """Starts reading the k-distributions of a species with the workers of
+    `pool` (see `parallel.executor`), in tasks of `BINS_PER_TASK` bins. The
+    first bin, which sets the grid, is read right away.
+
+    Returns
+    -------
+    PendingResults
+    """
+    data = read_bin_file(bin_filename(folder, sp, 0))
+    g = KGrid(data)
+    shape = (len(g.ng),len(g.P),len(g.T),nw)
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape))*8)
+    kcoeff = np.ndarray(shape, np.float64, buffer=shm.buf, order='F')
+    kcoeff[:] = -1
+    scatter_bin(kcoeff, g, data, nw-1)
+    del kcoeff
+    futures = [
+        pool.submit(_scatter_bin_files, shm.name, shape, g, folder, sp, range(l, min(l+BINS_PER_TASK, nw)))
+        for l in range(1, nw, BINS_PER_TASK)
+    ]
+    return PendingResults(g, shm, shape, futures)
+
+def read_helios_results(folder, sp, nw, pool=None):
+    """Reads the k-distributions of a species from all `nw` bin files.
+
+    If `pool` is given (see `parallel.executor`), the bins are read by its
+    workers. See `submit_helios_results`.
+
+    Returns
+    -------
+    g : ndarray
+        g-points
+    P : ndarray
+        Pressures (bar)
+    T : ndarray
+        Temperatures (K)
+    kcoeff : ndarray
+        Cross sections (cm^2/molecule), with shape (len(g), len(P), len(T), nw).
+    """
+    if pool is not None:
+        return submit_helios_results(pool, folder, sp, nw).result()
 
     for l in range(nw):
 
         print(l,end='\r')
 
-        with open(folder+'/Out_'+sp+'_bin'+str(l).rjust(4,'0')+'.dat','r') as f:
-            lines = f.readlines()
-        lines = remove_duplicates(lines)
-
-        k = KFile(len(lines))
-
-        for i,line in enumerate(lines):
-            tmp = line.split()
-            k.weights[i] = float(tmp[0])
-            k.xs[i] = float(tmp[1])
-            k.T[i] = float(tmp[2])
-            # atm * (1.01325 bar / 1 atm)
-            k.P[i] = float(tmp[3])*(1.01325/1)
-            k.weightsn[i] = float(tmp[4])
+        data = read_bin_file(bin_filename(folder, sp, l))
 
         if l == 0:
-            g = KGrid(k)
+            g = KGrid(data)
             kcoeff = np.ones((len(g.ng),len(g.P),len(g.T),nw),order='F')*-1
 
-        for i in range(len(k.xs)):
-            iT, iP, ig = helper(k, g, i)
-            kcoeff[ig,iP,iT,nw-l-1] = k.xs[i]
+        scatter_bin(kcoeff, g, data, nw-l-1)
             
     assert np.all(np.min(kcoeff) >= 0)
             
     return g.g, g.P, g.T, kcoeff
 
+def k_distribution(k, edges):
+    """k-distributions of spectra, averaged over g intervals. All wavenumbers
+    of a spectrum have the same weight.
+
+    Parameters
+    ----------
+    k : ndarray
+        Spectra with shape (..., nnu).
+    edges : ndarray
+        Increasing g edges from 0 to 1, e.g. `wogan_bins.weights_to_bins(weights)`.
+
+    Returns
+    -------
+    ndarray
+        Mean of k(g) in each g interval, with shape (..., len(edges)-1).
+    """
+    n = k.shape[-1]
+    ks = np.sort(k, axis=-1)
+    # Integral of the step function k(g) from 0 to each edge, in units of 1/n
+    cs = np.cumsum(ks, axis=-1, dtype=np.float64)
+    pos = np.asarray(edges, dtype=np.float64)*n
+    m = np.clip(np.floor(pos).astype(np.intp), 0, n-1)
+    frac = pos - m
+    integral = np.where(m > 0, cs[...,np.maximum(m-1,0)], 0.0) + frac*ks[...,m]
+    return np.diff(integral, axis=-1)/np.diff(pos)
+
+def kdistributions_from_spectra(heliosk_dir, sp, wavnum=None, weights=None, nnu_per_bin=wogan_grids.NNU_PER_BIN,
+                                max_bytes=256e6):
+    """Builds k-distributions straight from the full spectra in `Out_<sp>.bin`
+    (doStoreFullK = 2), instead of from HELIOS-K's `Out_<sp>_bin####.dat`
+    files. The opacities in each wavenumber interval are sorted and averaged
+    over the g intervals of `weights`, for all T and P at once.
+
+    Parameters
+    ----------
+    heliosk_dir : str
+        Directory containing the HELIOS-K outputs and `Manifest_<sp>.json`.
+    sp : str
+        Species name
+    wavnum : ndarray, optional
+        Decreasing interval edges in cm^-1. Default is `wogan_bins.wavnum`. All
+        wavenumbers in an interval are weighted equally, which is exact when every
+        interval is inside one interval of `wogan_bins.wavnum` (e.g. a finer scheme).
+    weights : ndarray, optional
+        Widths of the g intervals. Default is `wogan_bins.weights`.
+    nnu_per_bin : int
+        Number of wavenumbers in each bin of the HELIOS-K run.
+    max_bytes : float
+        Temperatures are processed in blocks that use about this much memory.
+
+    Returns
+    -------
+    The same as `read_helios_results`, with g at the middle of each g interval.
+    """
+    if wavnum is None:
+        wavnum = wogan_bins.wavnum
+    if weights is None:
+        weights = wogan_bins.weights
+    wavnum = np.asarray(wavnum, dtype=np.float64)
+    edges = wogan_bins.weights_to_bins(weights)
+    g = (edges[1:]+edges[:-1])/2
+
+    # Full spectra, on the grid of the HELIOS-K run
+    wno = wogan_grids.heliosk_wavenumbers(nnu_per_bin)
+    filename = os.path.join(heliosk_dir,'Out_'+sp+'.bin')
+    manifest = wogan_manifest.read_manifest(heliosk_dir, sp)
+    if manifest is None:
+        raise ValueError('Manifest_'+sp+'.json is needed to get the temperatures in '+filename)
+    T = wogan_manifest.check_manifest(manifest, filename, len(wno))
+    P = wogan_bins.P_grid
+    k = np.memmap(filename, dtype=np.float32, mode='r', shape=(len(T), len(P), len(wno)))
+    inds = np.argsort(T)
+
+    # kcoeff[:,:,:,j] is the interval between wavnum[j+1] and wavnum[j]
+    nw = len(wavnum)-1
+    start = np.searchsorted(wno, wavnum[1:], side='left')
+    stop = np.searchsorted(wno, wavnum[:-1], side='left')
+    if np.any(stop <= start):
+        raise ValueError('Some intervals of wavnum contain no wavenumbers of the HELIOS-K run')
+
+    kcoeff = np.empty((len(g),len(P),len(T),nw),order='F')
+    for j in range(nw):
+        # Enough temperatures per block for about max_bytes
+        nblock = max(1, int(max_bytes//(len(P)*(stop[j]-start[j])*(4+8))))
+        for i0 in range(0, len(T), nblock):
+            iT = inds[i0:i0+nblock]
+            kd = k_distribution(k[iT,:,start[j]:stop[j]], edges)
+            kcoeff[:,:,i0:i0+len(iT),j] = kd.transpose(2,1,0)
+
+    return g, P.copy(), T[inds], kcoeff
+
 def create_k_dataset(filename, sp, notes, weights, T, log10P, wavelengths, log10k):
 
     with h5py.File(filename, "w") as f:
@@ -132,7 +304,17 @@ log10k: [cm^2/molecule], dimensions (len(weights),len(log10P),len(T),len(wavelen
     assert len(notes) < 999
     return notes
 
-def main():
+@instrument.instrumented('make_photochem_ktable')
+@parallel.limited
+def main(nprocs=None, from_spectra=False):
+    """Builds the k-tables of all species.
+
+    When `nprocs > 1`, the bin files of all species are read by a pool of
+    worker processes at the same time. The k-tables are still written one
+    species at a time, in order. If None, then `parallel.nprocs()` is used.
+    If `from_spectra` is True, the k-distributions are computed from the full
+    spectra with `kdistributions_from_spectra` (one species per worker).
+    """
     # Inputs
     species = ['C2H2','C2H6','CH4','CO','CO2','H2O','HCl','N2O','NH3','O2','O3','OCS','SO2']
     output_folder = 'kdistributions/'
@@ -154,29 +336,60 @@ def main():
         dset[:] = ir_wavl
 
     # Loop through all species
+    if nprocs is None:
+        nprocs = parallel.nprocs()
     nw = len(wogan_bins.wavnum)-1
-    for i,sp in enumerate(species):
-
-        # Get results
-        g_value, P_grid, T_grid, kcoeff = read_helios_results('./', sp, nw)
-
-        # checks
-        assert np.all(np.isclose(P_grid,wogan_bins.P_grid,rtol=1e-10,atol=1e-20))
-        # assert np.all(np.isclose(T_grid,bins.T_grid,rtol=1e-10,atol=1e-20))
-        tmp = wogan_bins.weights_to_bins(wogan_bins.weights)
-        g = (tmp[1:]+tmp[:-1])/2
-        assert np.all(np.isclose(g, g_value))
-
-        # clip
-        kcoeff = np.clip(kcoeff, a_min=1.0e-60, a_max=np.inf)
-        log10k = np.log10(kcoeff) # log10
-        log10P = np.log10(P_grid)
-
-        notes = make_notes(commit, date, creator)
-
-        # create file
-        outfilename = os.path.join(output_folder,sp+".h5")
-        create_k_dataset(outfilename, sp, notes, wogan_bins.weights, T_grid, log10P, wogan_bins.wavl, log10k)
+    with (parallel.executor(nprocs) if nprocs > 1 else contextlib.nullcontext()) as pool:
+        if pool is not None and from_spectra:
+            pending = [pool.submit(kdistributions_from_spectra, './', sp) for sp in species]
+        elif pool is not None:
+            pending = [submit_helios_results(pool, './', sp, nw) for sp in species]
+
+        for i,sp in enumerate(species):
+
+            with instrument.stage('ktable', species=sp):
+                # Get results
+                with instrument.stage('read_helios_results', species=sp, nbins=nw):
+                    if pool is None and from_spectra:
+                        g_value, P_grid, T_grid, kcoeff = kdistributions_from_spectra('./', sp)
+                    elif pool is None:
+                        g_value, P_grid, T_grid, kcoeff = read_helios_results('./', sp, nw)
+                    else:
+                        g_value, P_grid, T_grid, kcoeff = pending[i].result()
+
+                # checks
+                assert np.all(np.isclose(P_grid,wogan_bins.P_grid,rtol=1e-10,atol=1e-20))
+                manifest = wogan_manifest.read_manifest('./', sp)
+                if manifest is not None:
+                    T_manifest = np.sort(manifest['T'])
+                    assert len(T_manifest) == len(T_grid) and np.allclose(T_manifest, T_grid), \
+                        sp+' k-distributions do not match the temperatures in its manifest'
+                # assert np.all(np.isclose(T_grid,bins.T_grid,rtol=1e-10,atol=1e-20))
+                tmp = wogan_bins.weights_to_bins(wogan_bins.weights)
+                g = (tmp[1:]+tmp[:-1])/2
+                assert np.all(np.isclose(g, g_value))
+
+                # clip
+                kcoeff = np.clip(kcoeff, a_min=1.0e-60, a_max=np.inf)
+                log10k = np.log10(kcoeff) # log10
+                log10P = np.log10(P_grid)
+
+                notes = make_notes(commit, date, creator)
+
+                # create file
+                outfilename = os.path.join(output_folder,sp+".h5")
+                with instrument.stage('create_k_dataset', species=sp):
+                    create_k_dataset(outfilename, sp, notes, wogan_bins.weights, T_grid, log10P, wogan_bins.wavl, log10k)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description='Builds the Photochem k-tables from HELIOS-K outputs.')
+    instrument.add_argument(parser)
+    parallel.add_arguments(parser)
+    parser.add_argument('--from-spectra', action='store_true',
+                        help='Compute the k-distributions from the full spectra in Out_<sp>.bin, '
+                             'instead of reading the Out_<sp>_bin####.dat files')
+    args = parser.parse_args()
+    instrument.setup(args)
+    parallel.setup(args)
+    main(from_spectra=args.from_spectra)
\ No newline at end of file
@@ -5,103 +5,301 @@ import io
 import h5py
 import pandas as pd
 from scipy import interpolate
-import numba as nb
+from scipy import sparse
+import hashlib
+import json
 import shutil
+import tempfile
 import requests
 import zipfile
+import numba as nb
 from wogan_data import bins as wogan_bins
-
-from threadpoolctl import threadpool_limits
-_ = threadpool_limits(limits=1)
+from wogan_data import grids as wogan_grids
+from wogan_data import manifest as wogan_manifest
+import opacity_codec
+import instrument
+import parallel
 
 T_GRID = wogan_bins.T_grid
 P_GRID = wogan_bins.P_grid
 WAVNUM = wogan_bins.wavnum
 
-@nb.njit()
-def reshape_data_array(data_array, nP, nT, nwno):
+def open_heliosk_output(filename, nT, nP, nwno):
+    """Memory-map a HELIOS-K `Out_<molecule>.bin` file without copying it.
 
-    i1 = nT - 1
-    i2 = nP - 1
-    i3 = nwno - 1
-    assert i3 + i2*nwno + i1*nP*nwno == len(data_array) - 1
-
-    k = np.empty((nT, nP, nwno),np.float32)
-    for i1 in range(nT):
-        for i2 in range(nP):
-            for i3 in range(nwno):
-                k[i1,i2,i3] = data_array[i3 + i2*nwno + i1*nP*nwno]
-    return k
+    Parameters
+    ----------
+    filename : str
+        Path to the `Out_<molecule>.bin` file (written with doStoreFullK = 2).
+    nT : int
+        Number of temperatures in the file.
+    nP : int
+        Number of pressures in the file.
+    nwno : int
+        Number of wavenumbers in each spectrum.
 
-def get_wavenumbers():
-    wavnums = WAVNUM[::-1]
-    wno = np.array([])
-    for i in range(len(wavnums)-1):
-        wno = np.append(wno, np.linspace(wavnums[i],wavnums[i+1],100_001)[:-1])
-    return wno
+    Returns
+    -------
+    k : np.memmap
+        Read-only float32 view indexed as k[t_index, p_index, wno_index]. Data
+        is only read from disk when a spectrum is accessed.
+    """
+    nbytes = os.path.getsize(filename)
+    assert nbytes == nT*nP*nwno*np.dtype(np.float32).itemsize, \
+        '%s has %i bytes, but (nT, nP, nwno) = (%i, %i, %i)'%(filename, nbytes, nT, nP, nwno)
+    return np.memmap(filename, dtype=np.float32, mode='r', shape=(nT, nP, nwno))
 
-def resave_as_h5_files(heliosk_dir, outdir):
+def iter_spectra(k):
+    """Yields (t_index, p_index, spectrum) for each (T, P) point of k[T, P, wno],
+    so that only one spectrum needs to be in memory at a time."""
+    for i in range(k.shape[0]):
+        for j in range(k.shape[1]):
+            yield i, j, k[i,j,:]
 
-    if not os.path.isdir(outdir):
-        os.mkdir(outdir)
+def read_heliosk_output(heliosk_dir, molecule, nwno):
+    """Gets the temperature grid and a memory-mapped opacity array for a molecule.
 
-    # Get the filenames
-    tmp = os.listdir(heliosk_dir)
-    filenames = [a for a in tmp if 'Out_' in a and '.bin' in a]
-    molecules = [a.replace('Out_','').replace('.bin','') for a in filenames]
+    Parameters
+    ----------
+    heliosk_dir : str
+        Directory containing the HELIOS-K outputs.
+    molecule : str
+        Molecule name
+    nwno : int
+        Number of wavenumbers in each spectrum.
 
-    # Wavenumber grid
-    wno = get_wavenumbers()
+    Returns
+    -------
+    T : ndarray
+        Array of temperatures in K
+    k : np.memmap
+        Opacities in cm^2/molecule, indexed as k[t_index, p_index, wno_index].
+    """
+    filename = os.path.join(heliosk_dir,'Out_'+molecule+'.bin')
+
+    # Get T grid from the manifest written by run_heliosk.py, or else from the
+    # k-distribution outputs of older runs
+    manifest = wogan_manifest.read_manifest(heliosk_dir, molecule)
+    if manifest is not None:
+        T = wogan_manifest.check_manifest(manifest, filename, nwno)
+    else:
+        _, _, T, _, _ = np.loadtxt(os.path.join(heliosk_dir,'Out_'+molecule+'_bin0000.dat')).T
+        T = np.unique(T)
 
-    # save
+    if len(T) == len(T_GRID):
+        if not np.allclose(T, T_GRID):
+            print('T does not match T_GRID:')
+            print(T)
+    else:
+        print('T does not match T_GRID:')
+        print(T)
+
+    k = open_heliosk_output(filename, len(T), len(P_GRID), nwno)
+    return T, k
+
+def get_wavenumbers(cache_dir=None):
+    """Wavenumber grid of the HELIOS-K full spectra (see `wogan_grids.heliosk_wavenumbers`).
+    If `cache_dir` is given, the grid is saved there as a `.npy` file and reused. The
+    filename has a hash of the bin edges, so a grid of other edges is never reused."""
+    if cache_dir is None:
+        return wogan_grids.heliosk_wavenumbers(wogan_grids.NNU_PER_BIN, WAVNUM)
+    if not os.path.isdir(cache_dir):
+        os.mkdir(cache_dir)
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(WAVNUM, dtype=np.float64).tobytes())
+    filename = os.path.join(cache_dir, 'wno_heliosk_%i_%s.npy'%(wogan_grids.NNU_PER_BIN, h.hexdigest()))
+    return wogan_grids.load_or_save(filename, wogan_grids.heliosk_wavenumbers, wogan_grids.NNU_PER_BIN, WAVNUM)
+
+def write_wavenumber_grid_h5(outdir, wno):
     filename = os.path.join(outdir,'wavenumber_grid.h5')
     with h5py.File(filename, 'w') as h5f:
         d_wno = h5f.create_dataset('wno', data=np.asarray(wno, dtype=np.float32), compression='gzip')
         d_wno.attrs['units'] = 'cm^-1'
         d_wno.attrs['description'] = 'Wavenumber grid in inverse centimeters'
 
-    # Insert line opacities
-    for i,molecule in enumerate(molecules):
-        print('Working on '+molecule)
+# Number of wavenumbers in each chunk of the k[T, P, wno] datasets
+H5_LAYOUTS = {
+    'spectrum': 1_048_576,
+    'window': 65_536,
+}
 
-        # Load the data
-        data_array = np.fromfile(heliosk_dir+'/'+filenames[i], dtype=np.float32)
+def h5_chunk_shape(nwno, layout='spectrum'):
+    """Chunk shape of a k[T, P, wno] dataset. Each chunk holds a single (T, P) point,
+    so reading one spectrum never decompresses data from other (T, P) points.
 
-        # Get T grid
-        _, _, T, _, _ = np.loadtxt('Out_'+molecule+'_bin0000.dat').T
-        T = np.unique(T)
-        if len(T) == len(T_GRID):
-            if not np.allclose(T, T_GRID):
-                print('T does not match T_GRID:')
-                print(T)
-        else:
-            print('T does not match T_GRID:')
-            print(T)
+    Parameters
+    ----------
+    nwno : int
+        Number of wavenumbers.
+    layout : str
+        'spectrum' (4 MB chunks) is best when whole spectra are read. 'window'
+        (256 kB chunks) is best when narrow wavenumber windows are read.
+
+    Returns
+    -------
+    tuple
+    """
+    return (1, 1, min(nwno, H5_LAYOUTS[layout]))
 
-        # reshape the data
-        k = reshape_data_array(data_array, len(P_GRID), len(T), len(wno))
+def create_molecule_h5(
+        h5f, molecule, T, P, nwno, 
+        layout='spectrum', chunks=None, compression='gzip', compression_opts=None, shuffle=False,
+        max_rel_error=None
+        ):
+    """Writes the T and P grids of a molecule to an open HDF5 file, and creates
+    an empty `k` dataset that opacities can be streamed into with `write_h5_opacities`.
 
-        # Save raw grids and opacities for this molecule to an HDF5 file
-        h5_filename = os.path.join(outdir, f'{molecule}.h5')
+    Parameters
+    ----------
+    h5f : h5py.File
+        Open HDF5 file.
+    molecule : str
+        Molecule name
+    T : ndarray
+        Array of temperatures in K
+    P : ndarray
+        Array of pressures in bar
+    nwno : int
+        Number of wavenumbers.
+    layout : str
+        Chunk layout, 'spectrum' or 'window' (see `h5_chunk_shape`).
+    chunks : tuple, optional
+        Explicit chunk shape, which overrides `layout`.
+    compression : str
+        'gzip', 'lzf' or None.
+    compression_opts : int, optional
+        gzip level (0-9).
+    shuffle : bool
+        If True, the shuffle filter is applied before compression.
+    max_rel_error : float, optional
+        If given, `k` stores log10 of the opacities quantized to uint16, with
+        a relative error of at most `max_rel_error`, and the datasets `k_offset`
+        and `k_scale` hold the quantization of each spectrum
+        (see `opacity_codec.quantize_log`).
+
+    Returns
+    -------
+    d_k : h5py.Dataset
+        Dataset of shape (len(T), len(P), nwno).
+    """
+    h5f.attrs['molecule'] = molecule
+
+    d_T = h5f.create_dataset('T', data=np.asarray(T, dtype=np.float32), compression='gzip')
+    d_T.attrs['units'] = 'K'
+    d_T.attrs['description'] = 'Temperature grid in Kelvin'
+
+    d_P = h5f.create_dataset('P', data=np.asarray(P, dtype=np.float32), compression='gzip')
+    d_P.attrs['units'] = 'bar'
+    d_P.attrs['description'] = 'Pressure grid in bar'
+
+    if chunks is None:
+        chunks = h5_chunk_shape(nwno, layout)
+    d_k = h5f.create_dataset(
+        'k', shape=(len(T), len(P), nwno), dtype=np.float32 if max_rel_error is None else np.uint16, 
+        chunks=chunks, compression=compression, compression_opts=compression_opts, shuffle=shuffle
+    )
+    d_k.attrs['units'] = 'cm^2/molecule'
+    d_k.attrs['description'] = (
+        'Opacity array indexed as k[t_index, p_index, wno_index], '
+        'where t_index spans T (K), p_index spans P (bar), and '
+        'wno_index spans wno (cm^-1).'
+    )
+    if max_rel_error is not None:
+        d_k.attrs['max_rel_error'] = max_rel_error
+        d_k.attrs['encoding'] = (
+            'log16: k = 10**(k_offset[t_index, p_index] + k[t_index, p_index, wno_index]*k_scale[t_index, p_index]), '
+            'except where k[t_index, p_index, wno_index] = 0, which is %g or less'%opacity_codec.LOG16_FLOOR
+        )
+        h5f.create_dataset('k_offset', shape=(len(T), len(P)), dtype=np.float64)
+        h5f.create_dataset('k_scale', shape=(len(T), len(P)), dtype=np.float64)
+    return d_k
+
+def write_h5_opacities(d_k, index, k):
+    """Writes opacities to `d_k[index]`, quantizing them if `d_k` was created
+    with `max_rel_error` (see `create_molecule_h5`).
+
+    Parameters
+    ----------
+    d_k : h5py.Dataset
+        Dataset from `create_molecule_h5`.
+    index : tuple
+        (t_index,) to write all pressures of a temperature, (t_index, slice) for
+        a block of pressures, or (t_index, p_index).
+    k : ndarray
+        Opacities in cm^2/molecule, of shape `d_k[index].shape`.
+    """
+    if 'max_rel_error' not in d_k.attrs:
+        d_k[index] = k
+        return
+    q, offset, scale = opacity_codec.quantize_log(k, d_k.attrs['max_rel_error'])
+    d_k[index] = q
+    d_k.parent['k_offset'][index] = offset
+    d_k.parent['k_scale'][index] = scale
+
+def resave_molecule_h5(heliosk_dir, molecule, h5_filename, nwno, h5_options=None):
+    """Streams the memory-mapped HELIOS-K outputs of a molecule into an HDF5 file,
+    one spectrum at a time. `h5_options` are keyword arguments of `create_molecule_h5`."""
+    if h5_options is None:
+        h5_options = {}
+    with instrument.stage('resave_molecule_h5', molecule=molecule):
+        T, k = read_heliosk_output(heliosk_dir, molecule, nwno)
         with h5py.File(h5_filename, 'w') as h5f:
+            d_k = create_molecule_h5(h5f, molecule, T, P_GRID, nwno, **h5_options)
+            for i, j, spectrum in iter_spectra(k):
+                write_h5_opacities(d_k, (i,j), spectrum)
+    return h5_filename
 
-            h5f.attrs['molecule'] = molecule
+@instrument.instrumented('resave_as_h5_files')
+@parallel.limited
+def resave_as_h5_files(heliosk_dir, outdir, nprocs=None, **h5_options):
+    """Saves the HELIOS-K outputs of every molecule as HDF5 files in `outdir`.
 
-            d_T = h5f.create_dataset('T', data=np.asarray(T, dtype=np.float32), compression='gzip')
-            d_T.attrs['units'] = 'K'
-            d_T.attrs['description'] = 'Temperature grid in Kelvin'
+    Parameters
+    ----------
+    heliosk_dir : str
+        Directory containing the HELIOS-K outputs.
+    outdir : str
+        Output directory.
+    nprocs : int, optional
+        Number of worker processes, each compressing a different molecule.
+        If None, then `parallel.nprocs()` is used.
+    **h5_options
+        Chunking and compression settings passed to `create_molecule_h5`, 
+        e.g. layout='window', compression='lzf', shuffle=True.
+    """
 
-            d_P = h5f.create_dataset('P', data=np.asarray(P_GRID, dtype=np.float32), compression='gzip')
-            d_P.attrs['units'] = 'bar'
-            d_P.attrs['description'] = 'Pressure grid in bar'
+    if nprocs is None:
+        nprocs = parallel.nprocs()
 
-            d_k = h5f.create_dataset('k', data=np.asarray(k, dtype=np.float32), compression='gzip')
-            d_k.attrs['units'] = 'cm^2/molecule'
-            d_k.attrs['description'] = (
-                'Opacity array indexed as k[t_index, p_index, wno_index], '
-                'where t_index spans T (K), p_index spans P (bar), and '
-                'wno_index spans wno (cm^-1).'
-            )
+    if not os.path.isdir(outdir):
+        os.mkdir(outdir)
+
+    # Get the filenames
+    tmp = os.listdir(heliosk_dir)
+    filenames = [a for a in tmp if 'Out_' in a and '.bin' in a]
+    molecules = [a.replace('Out_','').replace('.bin','') for a in filenames]
+
+    # Wavenumber grid
+    wno = get_wavenumbers()
+
+    # save
+    write_wavenumber_grid_h5(outdir, wno)
+
+    # Save raw grids and opacities for each molecule to an HDF5 file
+    h5_filenames = [os.path.join(outdir, f'{molecule}.h5') for molecule in molecules]
+    if nprocs > 1:
+        with parallel.executor(nprocs) as pool:
+            futures = [
+                pool.submit(resave_molecule_h5, heliosk_dir, molecule, h5_filename, len(wno), h5_options)
+                for molecule, h5_filename in zip(molecules, h5_filenames)
+            ]
+            for molecule, future in zip(molecules, futures):
+                future.result()
+                print('Finished '+molecule)
+    else:
+        for molecule, h5_filename in zip(molecules, h5_filenames):
+            print('Working on '+molecule)
+            resave_molecule_h5(heliosk_dir, molecule, h5_filename, len(wno), h5_options)
 
 def h5_files_readme(outdir):
 
@@ -155,14 +353,105 @@ Notes:
     with open(readme_path, 'w') as f:
         f.write('\n'.join(readme))
 
-def make_db(heliosk_dir, data_dir, min_wavelength, max_wavelength, new_R, old_R=1e6):
+def make_db(heliosk_dir, data_dir, min_wavelength, max_wavelength, new_R, old_R=1e6, method='point', cache_dir=None, nprocs=None,
+            codec='npy', dtype=None, max_rel_error=None, incremental=False):
+    """Builds a single PICASO opacity DB from HELIOS-K outputs. See `make_dbs`."""
+    dbs = make_dbs(
+        heliosk_dir, data_dir, [(min_wavelength, max_wavelength, new_R)], 
+        old_R=old_R, method=method, cache_dir=cache_dir, nprocs=nprocs,
+        codec=codec, dtype=dtype, max_rel_error=max_rel_error, incremental=incremental
+    )
+    return dbs[0]
+
+@instrument.instrumented('make_dbs')
+@parallel.limited
+def make_dbs(heliosk_dir, data_dir, targets, old_R=1e6, method='point', cache_dir=None, nprocs=None, h5_outdir=None,
+             h5_options=None, codec='npy', dtype=None, max_rel_error=None, cia_file=None, incremental=False, chain=False,
+             filenames=None):
+    """Builds several PICASO opacity DBs from HELIOS-K outputs. The outputs of each
+    molecule are read once, and every temperature slab is resampled to all targets
+    before moving on to the next one.
+
+    When `nprocs > 1`, each molecule is resampled by its own worker process
+    and written to separate SQLite shards. The shards are then merged, in
+    the same order that the serial build would use, into the final databases.
+    Each process uses `parallel.threads()` threads for resampling.
 
-    db = f'opacities_photochem_{min_wavelength}_{max_wavelength}_R{new_R}.db'
+    Parameters
+    ----------
+    heliosk_dir : str
+        Directory containing the HELIOS-K outputs.
+    data_dir : str
+        Photochem data directory with `xsections/` and `CIA/` subdirectories.
+    targets : list
+        List of (min_wavelength, max_wavelength, new_R) tuples, one for each database.
+        Wavelengths are in microns.
+    old_R : float
+        Spectral resolution of the intermediate grid that targets are downsampled from.
+    method : str
+        Resampling method, one of 'point', 'bin' or 'log' (see `ResamplingOperator`).
+    cache_dir : str, optional
+        Directory where resampling operators and interpolated photolysis cross 
+        sections are saved, and reused by later builds.
+    nprocs : int, optional
+        Number of worker processes. If None, then `parallel.nprocs()` is used.
+    h5_outdir : str, optional
+        If given, the raw opacities are also saved as HDF5 files in this directory
+        (the same files as `resave_as_h5_files`), in the same pass.
+    h5_options : dict, optional
+        Chunking and compression settings for the HDF5 files (see `create_molecule_h5`).
+    codec : str
+        Blob codec for opacities, 'npy' (readable by PICASO), 'raw' or the lossy
+        'log16' (see `opacity_codec`).
+    dtype : str, optional
+        dtype of the stored opacities. If None, then float64 is used.
+    max_rel_error : float, optional
+        Maximum relative error of the 'log16' codec. It is recorded in the header.
+    cia_file : str, optional
+        If given, the CIA data is also written to this text file (see `write_CIA_file`),
+        which is useful for debugging.
+    incremental : bool
+        If True, existing databases are updated instead of rebuilt. Only molecules
+        whose `Out_<molecule>.bin` or photolysis cross sections changed, according to
+        the content hashes in the `build_info` table, are replaced (likewise for the
+        continuum and the CIA files). Files whose size and modification time have
+        not changed are not hashed again. A database built with different parameters,
+        or without `incremental` (which skips hashing and leaves `build_info` empty),
+        is rebuilt from scratch. Each database is checked on its own, so a new target
+        is built in full without touching the others. With `h5_outdir`, molecules
+        that are up to date are still exported if their HDF5 file is missing.
+    chain : bool
+        If True, each target is resampled from the previous target, instead of from
+        the full resolution spectra, so targets must be in order of decreasing `new_R`.
+        This is how `make_pyramid` builds its levels. The grids of the targets are
+        not nested, so a chained target approximates the one built directly. It is
+        ignored with method='point', where every target samples the full resolution
+        spectra, which costs nothing extra in the same pass.
+    filenames : list, optional
+        Filenames of the databases, one for each target. If None, then they are
+        `opacities_photochem_{min_wavelength}_{max_wavelength}_R{new_R}.db` in the
+        working directory.
 
-    if os.path.exists(db):
-        os.remove(db)
+    Returns
+    -------
+    dbs : list
+        Filenames of the databases, in the order of `targets`.
+    """
 
-    build_skeleton(db)
+    if filenames is None:
+        dbs = [f'opacities_photochem_{min_wavelength}_{max_wavelength}_R{new_R}.db' 
+               for min_wavelength, max_wavelength, new_R in targets]
+    else:
+        if len(filenames) != len(targets):
+            raise ValueError('filenames must have one filename for each target')
+        dbs = list(filenames)
+    if chain and any(a[2] <= b[2] for a, b in zip(targets[:-1], targets[1:])):
+        raise ValueError('With chain=True, targets must be in order of decreasing new_R')
+    # Chained 'point' targets would interpolate the previous target's samples,
+    # instead of sampling the spectra
+    chain = chain and method != 'point'
+    if nprocs is None:
+        nprocs = parallel.nprocs()
 
     # Get the filenames
     tmp = os.listdir(heliosk_dir)
@@ -170,40 +459,343 @@ def make_db(heliosk_dir, data_dir, min_wavelength, max_wavelength, new_R, old_R=
     molecules = [a.replace('Out_','').replace('.bin','') for a in filenames]
 
     # Wavenumber grid
-    wno = get_wavenumbers()
+    wno = get_wavenumbers(cache_dir)
+
+    # Check that HELIOS-K was run on the grid we assume, and that every
+    # output is complete, before doing any work
+    for molecule in molecules:
+        wogan_grids.check_species_params(molecule)
+        read_heliosk_output(heliosk_dir, molecule, len(wno))
+
+    # Build parameters of each database
+    params = [
+        json.dumps({
+            'target': list(target), 'old_R': old_R, 'method': method, 'nwno': len(wno),
+            'codec': codec, 'dtype': opacity_codec.codec_dtype(codec, dtype), 'max_rel_error': max_rel_error,
+            'source': list(targets[m-1]) if chain and m > 0 else None
+        }, sort_keys=True)
+        for m, target in enumerate(targets)
+    ]
+
+    # Content hashes of the inputs, which are only needed for incremental builds
+    build_infos = [read_build_info(db) if incremental and os.path.exists(db) else {} for db in dbs]
+    if incremental:
+        hashes, stats = input_hashes(heliosk_dir, data_dir, molecules, build_infos)
+    else:
+        hashes, stats = {name: None for name in molecules+['continuum']}, None
+
+    # Decide what must be (re)built in each database
+    todo = []
+    for db, db_params, build_info in zip(dbs, params, build_infos):
+        if len(build_info) == 0 or any(a[1] != db_params for a in build_info.values()):
+            if os.path.exists(db):
+                os.remove(db)
+            build_skeleton(db)
+            db_todo = set(hashes)
+        else:
+            db_todo = set(name for name in hashes if build_info.get(name, (None,))[0] != hashes[name])
+            # Molecules that no longer have HELIOS-K outputs
+            delete_rows(db, [name for name in build_info if name not in hashes] + sorted(db_todo))
+        todo.append(db_todo)
+        if incremental:
+            print(db+': rebuilding '+(', '.join(sorted(db_todo)) if db_todo else 'nothing, it is up to date'))
+
+    # The targets that each molecule is written to. With chain, the targets before
+    # the last one are also resampled, but only written to where they are needed.
+    plans = {}
+    for molecule in molecules:
+        needed = [m for m in range(len(dbs)) if molecule in todo[m]]
+        if chain:
+            indices = list(range(needed[-1]+1)) if len(needed) > 0 else []
+        else:
+            indices = needed
+        # A missing HDF5 file is written even if no database needs the molecule
+        h5_missing = h5_outdir is not None and not os.path.exists(os.path.join(h5_outdir, f'{molecule}.h5'))
+        if len(needed) > 0 or h5_missing:
+            plans[molecule] = [(m, dbs[m] if m in needed else None) for m in indices]
+    molecules = [molecule for molecule in molecules if molecule in plans]
+
+    # Resampling operators, shared by all molecules
+    grids = []
+    operators = []
+    src_wno, src_bins = wno, 1
+    for min_wavelength, max_wavelength, new_R in targets:
+        new_wvno_grid, bins = resampled_grid(min_wavelength, max_wavelength, new_R, old_R)
+        nsub = max(1, int(round(bins/src_bins)))
+        grids.append(new_wvno_grid)
+        operators.append(resampling_operator(src_wno, new_wvno_grid, method, nsub=nsub, cache_dir=cache_dir))
+        if chain:
+            src_wno, src_bins = new_wvno_grid, bins
+
+    if h5_outdir is not None:
+        if not os.path.isdir(h5_outdir):
+            os.mkdir(h5_outdir)
+        write_wavenumber_grid_h5(h5_outdir, wno)
 
     # Insert line opacities
-    for i,molecule in enumerate(molecules):
-        print('Working on '+molecule)
-
-        # Load the data
-        data_array = np.fromfile(heliosk_dir+'/'+filenames[i], dtype=np.float32)
+    with instrument.stage('line_opacities', nmolecules=len(molecules), ntargets=len(dbs), nprocs=nprocs):
+        if nprocs > 1:
+            shards = {
+                molecule: [(m, None if db is None else db+'.'+molecule+'.shard') for m, db in plans[molecule]]
+                for molecule in molecules
+            }
+            with parallel.executor(nprocs, initializer=_init_worker, initargs=(grids, operators, chain, cache_dir)) as pool:
+                futures = [
+                    pool.submit(
+                        _build_molecule_shards, shards[molecule], heliosk_dir, molecule, 
+                        data_dir, len(wno), h5_outdir, h5_options, codec, dtype, max_rel_error
+                    )
+                    for molecule in molecules
+                ]
+                for molecule, future in zip(molecules, futures):
+                    future.result()
+                    print('Finished '+molecule)
+            for m, db in enumerate(dbs):
+                merge_shards(db, [shard for molecule in molecules for i, shard in shards[molecule] if i == m and shard is not None])
+        else:
+            for molecule in molecules:
+                print('Working on '+molecule)
+                plan = plans[molecule]
+                process_molecule(
+                    [db for _, db in plan], heliosk_dir, molecule, data_dir, 
+                    [grids[m] for m, _ in plan], [operators[m] for m, _ in plan], len(wno), h5_outdir, h5_options,
+                    codec=codec, dtype=dtype, max_rel_error=max_rel_error, chain=chain, cache_dir=cache_dir
+                )
 
-        # Get T grid
-        _, _, T, _, _ = np.loadtxt('Out_'+molecule+'_bin0000.dat').T
-        T = np.unique(T)
-        if len(T) == len(T_GRID):
-            if not np.allclose(T, T_GRID):
-                print('T does not match T_GRID:')
-                print(T)
+    # continuum
+    if any('continuum' in db_todo for db_todo in todo):
+        print('Working on continuum')
+        with instrument.stage('continuum', ntargets=len(dbs)):
+            cia_data = read_CIA_data(data_dir)
+            if cia_file is not None:
+                write_CIA_file(data_dir, cia_file, cia_data)
+            for db, new_wvno_grid, db_todo in zip(dbs, grids, todo):
+                if 'continuum' in db_todo:
+                    insert_continuum(db, data_dir, new_wvno_grid, cia_data, codec=codec, dtype=dtype, max_rel_error=max_rel_error)
+
+    with instrument.stage('indexes', ntargets=len(dbs)):
+        for db, db_params, db_todo in zip(dbs, params, todo):
+            if incremental:
+                write_build_info(db, {name: hashes[name] for name in db_todo}, db_params, stats)
+            create_indexes(db)
+
+    return dbs
+
+def process_molecule(dbs, heliosk_dir, molecule, data_dir, grids, operators, nwno, h5_outdir=None, 
+                     h5_options=None, codec='npy', dtype=None, max_rel_error=None, chain=False, cache_dir=None, verbose=True):
+    """Memory-maps the HELIOS-K outputs of one molecule, and inserts it into
+    each database (and optionally its HDF5 file) with a single read of the data.
+    """
+    with instrument.stage('insert_molecule', molecule=molecule, ntargets=len(dbs)) as record:
+        T, k = read_heliosk_output(heliosk_dir, molecule, nwno)
+        targets = list(zip(dbs, grids, operators))
+        if h5_outdir is None:
+            insert_molecule_targets(
+                targets, molecule, data_dir, T, P_GRID, k, 
+                codec=codec, dtype=dtype, max_rel_error=max_rel_error, chain=chain, cache_dir=cache_dir, verbose=verbose
+            )
         else:
-            print('T does not match T_GRID:')
-            print(T)
+            with h5py.File(os.path.join(h5_outdir, f'{molecule}.h5'), 'w') as h5f:
+                d_k = create_molecule_h5(h5f, molecule, T, P_GRID, nwno, **(h5_options or {}))
+                insert_molecule_targets(
+                    targets, molecule, data_dir, T, P_GRID, k, 
+                    d_k=d_k, codec=codec, dtype=dtype, max_rel_error=max_rel_error, chain=chain, cache_dir=cache_dir, 
+                    verbose=verbose
+                )
+        record['nspectra'] = len(T)*len(P_GRID)
+        record['heliosk_bytes'] = k.nbytes
+
+_WORKER_GRIDS = None
+_WORKER_OPERATORS = None
+_WORKER_CHAIN = False
+_WORKER_CACHE_DIR = None
+
+def _init_worker(grids, operators, chain=False, cache_dir=None):
+    global _WORKER_GRIDS, _WORKER_OPERATORS, _WORKER_CHAIN, _WORKER_CACHE_DIR
+    _WORKER_GRIDS = grids
+    _WORKER_OPERATORS = operators
+    _WORKER_CHAIN = chain
+    _WORKER_CACHE_DIR = cache_dir
+
+def _build_molecule_shards(shards, heliosk_dir, molecule, data_dir, nwno, h5_outdir, h5_options, codec, dtype, max_rel_error):
+    """Worker for `make_dbs`, which puts a single molecule into its own shard of 
+    each database. `shards` is a list of (target index, shard), where the shard
+    is None for targets that are only resampled (see `insert_molecule_targets`)."""
+    for _, shard in shards:
+        if shard is None:
+            continue
+        if os.path.exists(shard):
+            os.remove(shard)
+        build_skeleton(shard)
+    process_molecule(
+        [shard for _, shard in shards], heliosk_dir, molecule, data_dir, 
+        [_WORKER_GRIDS[m] for m, _ in shards], [_WORKER_OPERATORS[m] for m, _ in shards], nwno, h5_outdir, h5_options,
+        codec=codec, dtype=dtype, max_rel_error=max_rel_error, chain=_WORKER_CHAIN, cache_dir=_WORKER_CACHE_DIR, 
+        verbose=False
+    )
+    return shards
 
-        # reshape the data
-        k = reshape_data_array(data_array, len(P_GRID), len(T), len(wno))
+def merge_shards(db_f, shards, remove=True):
+    """Appends the molecular rows of each shard database to `db_f`, in the
+    order given, and copies the header if `db_f` does not have one yet.
 
-        # Put molecule into database
-        new_wvno_grid = insert_molecule(
-            db, molecule, data_dir,
-            min_wavelength, max_wavelength, new_R, 
-            old_R, wno, T, P_GRID, k
-        )
+    Parameters
+    ----------
+    db_f : str
+        Database to merge into, created with `build_skeleton`.
+    shards : list
+        Filenames of the shard databases.
+    remove : bool
+        If True, shards are deleted after they are merged.
+    """
+    with instrument.stage('merge_shards', db=db_f, nshards=len(shards)):
+        _merge_shards(db_f, shards)
 
-    # continuum
-    print('Working on continuum')
-    col_names = write_CIA_file(data_dir, 'continuum.txt')   
-    restruct_continuum('continuum.txt', col_names, new_wvno_grid, db, overwrite=False)
+    if remove:
+        for shard in shards:
+            os.remove(shard)
+
+def _merge_shards(db_f, shards):
+    conn = sqlite3.connect(db_f)
+    cur = conn.cursor()
+    journal_mode, synchronous = build_pragmas(cur)
+    cur.execute('PRAGMA journal_mode=%s'%journal_mode)
+    cur.execute('PRAGMA synchronous=%s'%synchronous)
+    for shard in shards:
+        cur.execute('ATTACH DATABASE ? AS shard', (shard,))
+        cur.execute('INSERT INTO molecular (ptid, molecule, pressure, temperature, opacity) '
+                    'SELECT ptid, molecule, pressure, temperature, opacity FROM shard.molecular ORDER BY id')
+        cur.execute('SELECT COUNT(*) FROM header')
+        if cur.fetchone()[0] == 0:
+            columns = 'pressure_unit, temperature_unit, wavenumber_grid, continuum_unit, molecular_unit, ' \
+                      'codec, codec_version, opacity_dtype, opacity_length, max_rel_error'
+            cur.execute('INSERT INTO header (%s) SELECT %s FROM shard.header'%(columns, columns))
+        conn.commit()
+        cur.execute('DETACH DATABASE shard')
+    cur.execute('PRAGMA journal_mode=DELETE')
+    conn.close()
+
+def file_hash(filename, h=None, blocksize=2**26):
+    """Updates (or creates) a blake2b hash with the contents of a file."""
+    if h is None:
+        h = hashlib.blake2b(digest_size=20)
+    with open(filename,'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            h.update(block)
+    return h
+
+def molecule_files(heliosk_dir, molecule, data_dir):
+    """The HELIOS-K output and photolysis cross sections (if any) of a molecule."""
+    filenames = [os.path.join(heliosk_dir,'Out_'+molecule+'.bin')]
+    filename = data_dir+'/xsections/'+molecule+'.h5'
+    if os.path.exists(filename):
+        filenames.append(filename)
+    return filenames
+
+def continuum_files(data_dir):
+    """All of the CIA files."""
+    cia_dir = data_dir+'/CIA'
+    return [os.path.join(cia_dir, a) for a in sorted(a for a in os.listdir(cia_dir) if '.h5' in a)]
+
+def molecule_hash(heliosk_dir, molecule, data_dir):
+    """Content hash of the HELIOS-K output and photolysis cross sections of a molecule."""
+    h = hashlib.blake2b(digest_size=20)
+    for filename in molecule_files(heliosk_dir, molecule, data_dir):
+        file_hash(filename, h)
+    return h.hexdigest()
+
+def continuum_hash(data_dir):
+    """Content hash of all of the CIA files."""
+    h = hashlib.blake2b(digest_size=20)
+    for filename in continuum_files(data_dir):
+        h.update(os.path.basename(filename).encode())
+        file_hash(filename, h)
+    return h.hexdigest()
+
+def file_stats(filenames):
+    """Names, sizes and modification times of files, as a JSON string. These are
+    compared before hashing the files, as a cheap check that they have not changed."""
+    stats = []
+    for filename in filenames:
+        st = os.stat(filename)
+        stats.append([os.path.basename(filename), st.st_size, st.st_mtime_ns])
+    return json.dumps(stats)
+
+def input_hashes(heliosk_dir, data_dir, molecules, build_infos):
+    """Content hashes of the inputs of each molecule and of the continuum ('continuum').
+
+    The files are only read if their sizes or modification times differ from those
+    recorded with the hash in any of `build_infos` (see `read_build_info`).
+
+    Returns
+    -------
+    hashes : dict
+        Content hash of each name.
+    stats : dict
+        `file_stats` of each name.
+    """
+    files = {molecule: molecule_files(heliosk_dir, molecule, data_dir) for molecule in molecules}
+    files['continuum'] = continuum_files(data_dir)
+    hashes = {}
+    stats = {}
+    for name, filenames in files.items():
+        stats[name] = file_stats(filenames)
+        for build_info in build_infos:
+            if name in build_info and build_info[name][2] == stats[name]:
+                hashes[name] = build_info[name][0]
+                break
+        else:
+            if name == 'continuum':
+                hashes[name] = continuum_hash(data_dir)
+            else:
+                hashes[name] = molecule_hash(heliosk_dir, name, data_dir)
+    return hashes, stats
+
+def read_build_info(db_f):
+    """Gets {name: (content_hash, params, file_stats)} from the build_info table of a 
+    database, or an empty dictionary if the table does not exist or the database
+    can not be read (e.g. an interrupted build left it corrupt), so it is rebuilt."""
+    conn = sqlite3.connect(db_f)
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='build_info'")
+        if cur.fetchone() is None:
+            return {}
+        cur.execute('SELECT name, content_hash, params, file_stats FROM build_info')
+        build_info = {a[0]: (a[1], a[2], a[3]) for a in cur.fetchall()}
+    except sqlite3.DatabaseError as e:
+        print('Rebuilding %s, which can not be read: %s'%(db_f, e))
+        return {}
+    finally:
+        conn.close()
+    return build_info
+
+def write_build_info(db_f, hashes, params, stats):
+    """Records the content hashes and `file_stats` of molecules (or 'continuum')
+    that were just built."""
+    conn = sqlite3.connect(db_f)
+    cur = conn.cursor()
+    cur.executemany('INSERT OR REPLACE INTO build_info (name, content_hash, params, file_stats) values (?,?,?,?)', 
+                    [(name, content_hash, params, stats[name]) for name, content_hash in hashes.items()])
+    conn.commit()
+    conn.close()
+
+def delete_rows(db_f, names):
+    """Deletes the rows of molecules (or of the continuum, with the name 'continuum')
+    from a database."""
+    conn = sqlite3.connect(db_f)
+    cur = conn.cursor()
+    for name in names:
+        if name == 'continuum':
+            cur.execute('DELETE FROM continuum')
+        else:
+            cur.execute('DELETE FROM molecular WHERE molecule = ?', (name,))
+        cur.execute('DELETE FROM build_info WHERE name = ?', (name,))
+    conn.commit()
+    conn.close()
 
 def adapt_array(arr):
     out = io.BytesIO()
@@ -214,6 +806,7 @@ def adapt_array(arr):
 def convert_array(text):
     out = io.BytesIO(text)
     out.seek(0)
+    return np.load(out)
 
 def open_local(db_f):
     """Code needed to open up local database, interpret arrays from bytes and return cursor"""
@@ -240,25 +833,215 @@ def create_grid(min_wavelength, max_wavelength, constant_R):
     -------
     wavenumber grid defined at constant Resolution
     """
-    spacing = (2.*constant_R+1.)/(2.*constant_R-1.)
-    
-    npts = np.log(max_wavelength/min_wavelength)/np.log(spacing)
-    
-    wsize = int(np.ceil(npts))+1
-    newwl = np.zeros(wsize)
-    newwl[0] = min_wavelength
-    
-    for j in range(1,wsize):
-        newwl[j] = newwl[j-1]*spacing
-    
-    return 1e4/newwl[::-1]
+    return wogan_grids.constant_R_grid(min_wavelength, max_wavelength, constant_R)
+
+class ResamplingOperator():
+    """Sparse linear operator that resamples spectra from a source wavenumber grid
+    onto a target wavenumber grid. The interpolation indices and weights are
+    computed once, and then applied to any number of spectra with a single sparse
+    matrix product.
+
+    Three methods are supported:
+        1) 'point': linear interpolation at the target wavenumbers.
+        2) 'bin': average of the linearly interpolated spectrum over each target bin.
+        3) 'log': same as 'bin', but the average is taken over log10 of the spectrum.
+
+    Target bins are bounded by the midpoints between target wavenumbers. Bin averages
+    are computed by sampling each bin at `nsub` points evenly spaced in log(wavenumber).
+    Where the target grid extends outside the source grid, the spectrum is taken
+    to be `fill`.
+    """
+
+    methods = ('point', 'bin', 'log')
+
+    def __init__(self, matrix, offset, method, fill):
+        self.matrix = matrix.tocsr()
+        self.offset = offset
+        self.method = method
+        self.fill = fill
+
+    @classmethod
+    def build(cls, src_wno, dst_wno, method='point', nsub=1, fill=1e-50):
+        """Builds the operator.
+
+        Parameters
+        ----------
+        src_wno : ndarray
+            Increasing wavenumber grid of the spectra that will be resampled (cm^-1).
+        dst_wno : ndarray
+            Increasing wavenumber grid to resample onto (cm^-1).
+        method : str
+            One of 'point', 'bin' or 'log'.
+        nsub : int
+            Number of samples per target bin for the 'bin' and 'log' methods.
+        fill : float
+            Value of the spectrum outside of `src_wno`.
+
+        Returns
+        -------
+        ResamplingOperator
+        """
+        if method not in cls.methods:
+            raise ValueError('method must be one of '+', '.join(cls.methods))
+        src_wno = np.asarray(src_wno, dtype=np.float64)
+        dst_wno = np.asarray(dst_wno, dtype=np.float64)
+        ndst = len(dst_wno)
+
+        if method == 'point':
+            x = dst_wno
+            rows = np.arange(ndst)
+            nsub = 1
+        else:
+            # Bin edges are midpoints between target wavenumbers
+            log_wno = np.log(dst_wno)
+            edges = np.empty(ndst+1)
+            edges[1:-1] = (log_wno[1:] + log_wno[:-1])/2
+            edges[0] = log_wno[0] - (edges[1] - log_wno[0])
+            edges[-1] = log_wno[-1] + (log_wno[-1] - edges[-2])
+            frac = (np.arange(nsub) + 0.5)/nsub
+            x = np.exp(edges[:-1,None] + (edges[1:] - edges[:-1])[:,None]*frac[None,:]).ravel()
+            rows = np.repeat(np.arange(ndst), nsub)
+
+        # Linear interpolation weights for every sample point
+        inside = (x >= src_wno[0]) & (x <= src_wno[-1])
+        j = np.clip(np.searchsorted(src_wno, x, side='right') - 1, 0, len(src_wno) - 2)
+        w = (x - src_wno[j])/(src_wno[j+1] - src_wno[j])
+        w = np.clip(w, 0.0, 1.0)
+
+        rows = rows[inside]
+        j = j[inside]
+        w = w[inside]
+        data = np.concatenate(((1.0 - w)/nsub, w/nsub))
+        matrix = sparse.csr_matrix(
+            (data, (np.concatenate((rows, rows)), np.concatenate((j, j+1)))),
+            shape=(ndst, len(src_wno))
+        )
+        matrix.sum_duplicates()
+
+        # Contribution of samples that fall outside of the source grid
+        noutside = nsub - np.bincount(rows, minlength=ndst)
+        if method == 'log':
+            offset = noutside*np.log10(fill)/nsub
+        else:
+            offset = noutside*fill/nsub
+
+        return cls(matrix, offset, method, fill)
+
+    def apply(self, spectra):
+        """Resamples one spectrum, or a batch of spectra.
+
+        Parameters
+        ----------
+        spectra : ndarray
+            Shape (nsrc,) or (nspectra, nsrc).
+
+        Returns
+        -------
+        ndarray
+            Resampled spectra in float64 with shape (ndst,) or (nspectra, ndst).
+        """
+        x = np.asarray(spectra)
+        if self.method == 'log':
+            x = np.log10(np.maximum(x, 1e-200, dtype=np.float64))
+        if parallel.threads() > 1:
+            x2 = x.reshape((-1, x.shape[-1]))
+            y = np.empty((x2.shape[0], self.matrix.shape[0]))
+            _csr_apply_parallel(self.matrix.indptr, self.matrix.indices, self.matrix.data, x2, self.offset, y)
+            y = y.reshape(x.shape[:-1] + (self.matrix.shape[0],))
+        else:
+            y = np.ascontiguousarray((self.matrix @ x.T).T) + self.offset
+        if self.method == 'log':
+            y = 10.0**y
+        return y
+
+    def save(self, filename):
+        """Saves the operator to a `.npz` file."""
+        np.savez(
+            filename, data=self.matrix.data, indices=self.matrix.indices,
+            indptr=self.matrix.indptr, shape=np.array(self.matrix.shape),
+            offset=self.offset, method=self.method, fill=self.fill
+        )
+
+    @classmethod
+    def load(cls, filename):
+        """Loads an operator written by `save`."""
+        with np.load(filename) as f:
+            matrix = sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+            return cls(matrix, f['offset'], str(f['method']), float(f['fill']))
+
+@nb.njit(parallel=True)
+def _csr_apply_parallel(indptr, indices, data, x, offset, y):
+    # Same operations, in the same order, as scipy's CSR product followed by
+    # adding the offset, so the results are bit-identical.
+    for r in nb.prange(y.shape[1]):
+        for s in range(x.shape[0]):
+            acc = 0.0
+            for jj in range(indptr[r], indptr[r+1]):
+                acc += data[jj]*x[s,indices[jj]]
+            y[s,r] = acc + offset[r]
+
+@nb.njit(parallel=True)
+def _clip_min_parallel(y, floor):
+    for s in nb.prange(y.shape[0]):
+        for r in range(y.shape[1]):
+            if y[s,r] < floor:
+                y[s,r] = floor
+
+def clip_min(y, floor):
+    """Sets the values of a 2D array that are below `floor` to `floor`, in place."""
+    if parallel.threads() > 1:
+        _clip_min_parallel(y, floor)
+    else:
+        y[y<floor] = floor
+
+def resampling_operator(src_wno, dst_wno, method='point', nsub=1, fill=1e-50, cache_dir=None):
+    """Gets a `ResamplingOperator`, loading it from `cache_dir` if it was built
+    before for the same grids and settings, and saving it there otherwise.
+    """
+    if cache_dir is None:
+        return ResamplingOperator.build(src_wno, dst_wno, method, nsub, fill)
+
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(src_wno, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(dst_wno, dtype=np.float64).tobytes())
+    h.update(('%s %i %r'%(method, nsub, fill)).encode())
+    filename = os.path.join(cache_dir, 'resample_'+h.hexdigest()+'.npz')
+
+    if os.path.exists(filename):
+        return ResamplingOperator.load(filename)
+
+    if not os.path.isdir(cache_dir):
+        os.mkdir(cache_dir)
+    op = ResamplingOperator.build(src_wno, dst_wno, method, nsub, fill)
+    op.save(filename)
+    return op
+
+def resampled_grid(min_wavelength, max_wavelength, new_R, old_R):
+    """Gets the wavenumber grid with resolution `new_R`, made by downsampling
+    a constant `old_R` grid.
+
+    Returns
+    -------
+    new_wvno_grid : ndarray
+        Wavenumber grid of the new resampling
+    bins : int
+        Degree to which the `old_R` grid is downsampled
+    """
+    # Wavenumber grid that we will interpolate LBL opacities to
+    interp_wvno_grid = create_grid(min_wavelength, max_wavelength, old_R)
+
+    # Degree to which to downsample
+    bins = int(old_R/new_R)
+
+    return interp_wvno_grid[::bins], bins
 
 def build_skeleton(db_f):
     """
-    This functionb builds a skeleton sqlite3 database with three tables:
+    This functionb builds a skeleton sqlite3 database with four tables:
         1) header
         2) molecular
         3) continuum
+        4) build_info
 
     Parameters
     ----------
@@ -274,7 +1057,12 @@ def build_skeleton(db_f):
         temperature_unit VARCHAR,
         wavenumber_grid array,
         continuum_unit VARCHAR,
-        molecular_unit VARCHAR
+        molecular_unit VARCHAR,
+        codec VARCHAR,
+        codec_version INTEGER,
+        opacity_dtype VARCHAR,
+        opacity_length INTEGER,
+        max_rel_error FLOAT
         );"""
 
     cur.executescript(command)
@@ -297,16 +1085,371 @@ def build_skeleton(db_f):
         temperature FLOAT,
         opacity array);"""
 
+    cur.executescript(command)
+    #content hashes of the inputs, used for incremental rebuilds
+    command = """DROP TABLE IF EXISTS build_info;
+    CREATE TABLE build_info (
+        name VARCHAR PRIMARY KEY,
+        content_hash VARCHAR,
+        params VARCHAR,
+        file_stats VARCHAR);"""
+
     cur.executescript(command)
     
     conn.commit() #this commits the changes to the database
     conn.close()
 
+def build_pragmas(cur):
+    """SQLite journal mode and synchronous setting for writing to a database.
+
+    A database without `build_info` rows holds nothing that an incremental build
+    would keep, so if writing to it is interrupted it is rebuilt from scratch, and
+    the rollback journal and fsyncs are turned off. A database that is updated in
+    place uses WAL instead, so an interrupted update is rolled back.
+
+    Parameters
+    ----------
+    cur : sqlite3.Cursor
+        Cursor of the database.
+
+    Returns
+    -------
+    journal_mode : str
+    synchronous : str
+    """
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='build_info'")
+    if cur.fetchone() is not None:
+        cur.execute('SELECT COUNT(*) FROM build_info')
+        if cur.fetchone()[0] > 0:
+            return 'WAL', 'NORMAL'
+    return 'OFF', 'OFF'
+
+class DBWriter():
+    """Writer used while building a PICASO opacity DB. Rows are buffered and
+    inserted with `executemany`, all inside a single transaction that is
+    committed by `close`. The journal mode and fsyncs are set by `build_pragmas`,
+    unless `journal_mode` is given.
+
+    Parameters
+    ----------
+    db_f : str
+        Database file name, created with `build_skeleton`.
+    journal_mode : str, optional
+        SQLite journal mode used during the build, e.g. 'OFF' or 'WAL'.
+    batch_size : int
+        Number of buffered rows that triggers an `executemany`.
+    codec : str
+        Blob codec for opacities, 'npy', 'raw' or 'log16' (see `opacity_codec`).
+    dtype : str, optional
+        dtype of the stored opacities. If None, then float64 is used.
+    max_rel_error : float, optional
+        Maximum relative error of the 'log16' codec.
+    """
+
+    def __init__(self, db_f, journal_mode=None, batch_size=64, codec='npy', dtype=None, max_rel_error=None):
+        self.cur, self.conn = open_local(db_f)
+        self.codec = codec
+        self.dtype = np.dtype('<f8' if dtype is None else dtype).newbyteorder('<')
+        if codec == 'log16' and max_rel_error is None:
+            max_rel_error = opacity_codec.LOG16_DEFAULT_ERROR
+        self.max_rel_error = max_rel_error if codec == 'log16' else None
+        default_journal_mode, synchronous = build_pragmas(self.cur)
+        if journal_mode is None:
+            journal_mode = default_journal_mode
+        self.cur.execute('PRAGMA journal_mode=%s'%journal_mode)
+        self.cur.execute('PRAGMA synchronous=%s'%synchronous)
+        self.cur.execute('PRAGMA temp_store=MEMORY')
+        self.batch_size = batch_size
+        self.molecular = []
+        self.continuum = []
+
+    def add_molecular(self, ptid, molecule, temperature, pressure, opacity):
+        opacity = opacity_codec.encode(opacity, self.codec, self.dtype, self.max_rel_error)
+        self.molecular.append((int(ptid), molecule, float(temperature), float(pressure), opacity))
+        if len(self.molecular) >= self.batch_size:
+            self.flush()
+
+    def add_continuum(self, molecule, temperature, opacity):
+        opacity = opacity_codec.encode(opacity, self.codec, self.dtype, self.max_rel_error)
+        self.continuum.append((molecule, float(temperature), opacity))
+        if len(self.continuum) >= self.batch_size:
+            self.flush()
+
+    def set_header(self, wavenumber_grid):
+        """Inserts the header row, unless the database already has one."""
+        self.cur.execute('SELECT pressure_unit from header')
+        if len(self.cur.fetchall()) == 0:
+            self.cur.execute('INSERT INTO header (pressure_unit, temperature_unit, wavenumber_grid, continuum_unit, molecular_unit, '
+                             'codec, codec_version, opacity_dtype, opacity_length, max_rel_error) values (?,?,?,?,?,?,?,?,?,?)',
+                    ('bar','kelvin', np.array(wavenumber_grid), 'cm-1 amagat-2', 'cm2/molecule',
+                     self.codec, opacity_codec.CODEC_VERSION, opacity_codec.codec_dtype(self.codec, self.dtype), 
+                     len(wavenumber_grid), self.max_rel_error))
+
+    def flush(self):
+        if len(self.molecular) > 0:
+            self.cur.executemany('INSERT INTO molecular (ptid, molecule, temperature, pressure, opacity) values (?,?,?,?,?)', self.molecular)
+            self.molecular = []
+        if len(self.continuum) > 0:
+            self.cur.executemany('INSERT INTO continuum (molecule, temperature, opacity) values (?,?,?)', self.continuum)
+            self.continuum = []
+
+    def close(self):
+        self.flush()
+        self.conn.commit()
+        self.cur.execute('PRAGMA journal_mode=DELETE')
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def create_indexes(db_f):
+    """Creates the indexes used to look up one molecule, or one (T, P) point, 
+    in a finished database. These are created after all rows are inserted, 
+    which is much faster than maintaining them during the build.
+    """
+    conn = sqlite3.connect(db_f)
+    cur = conn.cursor()
+    cur.executescript("""
+    CREATE INDEX IF NOT EXISTS molecular_molecule_ptid ON molecular (molecule, ptid);
+    CREATE INDEX IF NOT EXISTS molecular_molecule_tp ON molecular (molecule, temperature, pressure);
+    CREATE INDEX IF NOT EXISTS continuum_molecule_temperature ON continuum (molecule, temperature);
+    ANALYZE;
+    """)
+    conn.commit()
+    conn.close()
+
+# Resolutions of the levels built by `make_pyramid`, from finest to coarsest
+PYRAMID_LEVELS = (300_000, 100_000, 60_000, 15_000)
+
+def make_pyramid(heliosk_dir, data_dir, min_wavelength, max_wavelength, levels=PYRAMID_LEVELS, pyramid_db=None, 
+                 levels_dir=None, **kwargs):
+    """Builds a resolution pyramid: PICASO opacities at several resolutions in a
+    single SQLite file. With method='point', every level samples the HELIOS-K outputs,
+    and is identical to a DB built directly with `make_db`. With 'bin' and 'log', the
+    finest level is resampled from the HELIOS-K outputs, and every other level from
+    the level before it (see `make_dbs`). Use `extract_level` to get a regular PICASO
+    DB for one level.
+
+    Each level is first built as a separate database, which never overwrites the
+    databases of `make_dbs` in the working directory.
+
+    Parameters
+    ----------
+    heliosk_dir : str
+        Directory containing the HELIOS-K outputs.
+    data_dir : str
+        Photochem data directory.
+    min_wavelength : float
+        min wavelength in microns.
+    max_wavelength : float
+        max wavelength in microns.
+    levels : tuple
+        Resolutions of the levels, in decreasing order.
+    pyramid_db : str, optional
+        Output filename.
+    levels_dir : str, optional
+        Directory where the database of each level is built and kept, which is
+        needed for `incremental` builds. If None, then they are built in a temporary
+        directory next to `pyramid_db`, which is removed afterwards.
+    **kwargs
+        Passed to `make_dbs`, e.g. old_R, method, nprocs or codec.
+
+    Returns
+    -------
+    pyramid_db : str
+        Output filename.
+    """
+    if pyramid_db is None:
+        pyramid_db = f'opacities_photochem_{min_wavelength}_{max_wavelength}_pyramid.db'
+    if kwargs.get('incremental', False) and levels_dir is None:
+        raise ValueError('An incremental pyramid needs levels_dir, where the levels are kept')
+    targets = [(min_wavelength, max_wavelength, new_R) for new_R in levels]
+    if levels_dir is None:
+        tmpdir = tempfile.mkdtemp(prefix='.levels_', dir=os.path.dirname(os.path.abspath(pyramid_db)))
+    else:
+        tmpdir = None
+        os.makedirs(levels_dir, exist_ok=True)
+    try:
+        filenames = [
+            os.path.join(tmpdir if levels_dir is None else levels_dir, f'R{new_R}.db') for new_R in levels
+        ]
+        dbs = make_dbs(heliosk_dir, data_dir, targets, chain=True, filenames=filenames, **kwargs)
+        merge_levels(pyramid_db, dbs, levels)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+    return pyramid_db
+
+def build_pyramid_skeleton(db_f):
+    """Builds an empty pyramid database. It has the tables of `build_skeleton`, plus a
+    `level` column in the molecular and continuum tables, and a `levels` table with 
+    the resolution and wavenumber grid of each level.
+    """
+    build_skeleton(db_f)
+    cur, conn = open_local(db_f)
+    cur.executescript("""
+    ALTER TABLE molecular ADD COLUMN level INTEGER;
+    ALTER TABLE continuum ADD COLUMN level INTEGER;
+    DROP TABLE IF EXISTS levels;
+    CREATE TABLE levels (
+        level INTEGER PRIMARY KEY,
+        R FLOAT,
+        wavenumber_grid array);
+    """)
+    conn.commit()
+    conn.close()
+
+def merge_levels(pyramid_db, dbs, levels):
+    """Copies PICASO DBs into a new pyramid database, as levels 0, 1, 2, ...
+
+    Parameters
+    ----------
+    pyramid_db : str
+        Output filename. An existing file is replaced.
+    dbs : list
+        Filenames of the databases of each level.
+    levels : list
+        Resolution of each level.
+    """
+    if os.path.exists(pyramid_db):
+        os.remove(pyramid_db)
+    build_pyramid_skeleton(pyramid_db)
+    conn = sqlite3.connect(pyramid_db)
+    cur = conn.cursor()
+    cur.execute('PRAGMA journal_mode=OFF')
+    cur.execute('PRAGMA synchronous=OFF')
+    for level, (db, new_R) in enumerate(zip(dbs, levels)):
+        cur.execute('ATTACH DATABASE ? AS src', (db,))
+        cur.execute('INSERT INTO molecular (ptid, molecule, pressure, temperature, opacity, level) '
+                    'SELECT ptid, molecule, pressure, temperature, opacity, ? FROM src.molecular ORDER BY id', (level,))
+        cur.execute('INSERT INTO continuum (molecule, temperature, opacity, level) '
+                    'SELECT molecule, temperature, opacity, ? FROM src.continuum ORDER BY id', (level,))
+        cur.execute('INSERT INTO levels (level, R, wavenumber_grid) '
+                    'SELECT ?, ?, wavenumber_grid FROM src.header', (level, float(new_R)))
+        if level == 0:
+            columns = 'pressure_unit, temperature_unit, wavenumber_grid, continuum_unit, molecular_unit, ' \
+                      'codec, codec_version, opacity_dtype, opacity_length, max_rel_error'
+            cur.execute('INSERT INTO header (%s) SELECT %s FROM src.header'%(columns, columns))
+        conn.commit()
+        cur.execute('DETACH DATABASE src')
+    cur.executescript("""
+    CREATE INDEX IF NOT EXISTS molecular_level_molecule_ptid ON molecular (level, molecule, ptid);
+    CREATE INDEX IF NOT EXISTS continuum_level_molecule_temperature ON continuum (level, molecule, temperature);
+    ANALYZE;
+    """)
+    cur.execute('PRAGMA journal_mode=DELETE')
+    conn.close()
+
+def read_levels(pyramid_db):
+    """Gets the (level, R) of every level in a pyramid database."""
+    conn = sqlite3.connect(pyramid_db)
+    cur = conn.cursor()
+    cur.execute('SELECT level, R FROM levels ORDER BY level')
+    levels = cur.fetchall()
+    conn.close()
+    return levels
+
+def extract_level(pyramid_db, level, new_db):
+    """Writes one level of a pyramid database to a regular PICASO DB.
+
+    Parameters
+    ----------
+    pyramid_db : str
+        Pyramid database from `make_pyramid`.
+    level : int
+        Level to extract (see `read_levels`).
+    new_db : str
+        Output filename. An existing file is replaced.
+    """
+    if os.path.exists(new_db):
+        os.remove(new_db)
+    build_skeleton(new_db)
+    conn = sqlite3.connect(new_db)
+    cur = conn.cursor()
+    cur.execute('PRAGMA journal_mode=OFF')
+    cur.execute('ATTACH DATABASE ? AS src', (pyramid_db,))
+    cur.execute('SELECT wavenumber_grid FROM src.levels WHERE level = ?', (level,))
+    result = cur.fetchone()
+    if result is None:
+        conn.close()
+        raise ValueError('%s has no level %i'%(pyramid_db, level))
+    wavenumber_grid = result[0]
+    cur.execute('INSERT INTO molecular (ptid, molecule, pressure, temperature, opacity) '
+                'SELECT ptid, molecule, pressure, temperature, opacity FROM src.molecular WHERE level = ? ORDER BY id', (level,))
+    cur.execute('INSERT INTO continuum (molecule, temperature, opacity) '
+                'SELECT molecule, temperature, opacity FROM src.continuum WHERE level = ? ORDER BY id', (level,))
+    columns = 'pressure_unit, temperature_unit, continuum_unit, molecular_unit, ' \
+              'codec, codec_version, opacity_dtype, max_rel_error'
+    cur.execute('INSERT INTO header (%s, wavenumber_grid, opacity_length) SELECT %s, ?, ? FROM src.header'%(columns, columns), 
+                (wavenumber_grid, len(convert_array(wavenumber_grid))))
+    conn.commit()
+    cur.execute('DETACH DATABASE src')
+    cur.execute('PRAGMA journal_mode=DELETE')
+    conn.close()
+    create_indexes(new_db)
+    return new_db
+
+def extract_window(db_f, min_wavelength, max_wavelength, new_db):
+    """Writes the part of a PICASO DB between two wavelengths to a new, smaller,
+    standalone PICASO DB. 'raw' and 'log16' blobs are cut without decoding them.
+
+    Parameters
+    ----------
+    db_f : str
+        PICASO opacity DB (use `extract_level` first for a pyramid database).
+    min_wavelength : float
+        min wavelength in microns.
+    max_wavelength : float
+        max wavelength in microns.
+    new_db : str
+        Output filename. An existing file is replaced.
+    """
+    cur, conn = open_local(db_f)
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='levels'")
+    if cur.fetchone() is not None:
+        conn.close()
+        raise ValueError(db_f+' is a pyramid database. Use extract_level first.')
+    codec, dtype = opacity_codec.read_codec(cur)
+    cur.execute('SELECT wavenumber_grid FROM header')
+    wno = cur.fetchone()[0]
+    conn.close()
+    start, stop = wogan_grids.window_indices(wno, min_wavelength, max_wavelength)
+
+    if os.path.exists(new_db):
+        os.remove(new_db)
+    build_skeleton(new_db)
+    cur, conn = open_local(new_db)
+    conn.create_function('slice_opacity', 1, lambda blob: opacity_codec.slice_blob(blob, codec, dtype, start, stop))
+    cur.execute('PRAGMA journal_mode=OFF')
+    cur.execute('ATTACH DATABASE ? AS src', (db_f,))
+    cur.execute('INSERT INTO molecular (ptid, molecule, pressure, temperature, opacity) '
+                'SELECT ptid, molecule, pressure, temperature, slice_opacity(opacity) FROM src.molecular ORDER BY id')
+    cur.execute('INSERT INTO continuum (molecule, temperature, opacity) '
+                'SELECT molecule, temperature, slice_opacity(opacity) FROM src.continuum ORDER BY id')
+    # Older databases do not have all of the header columns
+    cur.execute('PRAGMA src.table_info(header)')
+    src_columns = [a[1] for a in cur.fetchall()]
+    columns = ', '.join(a for a in [
+        'pressure_unit', 'temperature_unit', 'continuum_unit', 'molecular_unit', 
+        'codec', 'codec_version', 'opacity_dtype', 'max_rel_error'
+    ] if a in src_columns)
+    cur.execute('INSERT INTO header (%s, wavenumber_grid, opacity_length) SELECT %s, ?, ? FROM src.header'%(columns, columns), 
+                (np.array(wno[start:stop]), stop - start))
+    conn.commit()
+    cur.execute('DETACH DATABASE src')
+    cur.execute('PRAGMA journal_mode=DELETE')
+    conn.close()
+    create_indexes(new_db)
+    return new_db
+
 def insert_molecule(
         new_db, molecule, data_dir,
         min_wavelength, max_wavelength, new_R, 
         old_R, og_wvno_grid, T, P, k,
-        verbose=True
+        method='point', operator=None, codec='npy', dtype=None, max_rel_error=None, verbose=True
         ):
     """Insert molecule into PICASO opacity DB
 
@@ -332,6 +1475,19 @@ def insert_molecule(
         Array of pressures in bar
     k : ndarray
         Opacities in cm^2/molecule. shape is `(len(T),len(P),len(og_wvno_grid))`.
+        Can be a memory-mapped array (see `read_heliosk_output`), in which case
+        spectra are read from disk a block at a time (see `insert_molecule_targets`).
+    method : str
+        Resampling method, one of 'point', 'bin' or 'log' (see `ResamplingOperator`).
+    operator : ResamplingOperator, optional
+        Precomputed operator from `og_wvno_grid` to the new grid. If not given,
+        then it is built here.
+    codec : str
+        Blob codec for opacities, 'npy', 'raw' or 'log16' (see `opacity_codec`).
+    dtype : str, optional
+        dtype of the stored opacities. If None, then float64 is used.
+    max_rel_error : float, optional
+        Maximum relative error of the 'log16' codec.
 
     Returns
     -------
@@ -339,75 +1495,224 @@ def insert_molecule(
         Wavenumber grid of the new resampling
     """    
     
-    cur, conn = open_local(new_db)
+    # New wavenumber grid after downsampling
+    new_wvno_grid, bins = resampled_grid(min_wavelength, max_wavelength, new_R, old_R)
 
-    # Wavenumber grid that we will interpolate LBL opacities to
-    interp_wvno_grid = create_grid(min_wavelength, max_wavelength, old_R)
-    
-    # Degree to which to downsample
-    bins = int(old_R/new_R)
+    # Operator that resamples LBL opacities to the new grid
+    if operator is None:
+        operator = resampling_operator(og_wvno_grid, new_wvno_grid, method, nsub=bins)
 
-    # New wavenumber grid after downsampling
-    new_wvno_grid = interp_wvno_grid[::bins]
+    insert_molecule_targets(
+        [(new_db, new_wvno_grid, operator)], molecule, data_dir, T, P, k, 
+        codec=codec, dtype=dtype, max_rel_error=max_rel_error, verbose=verbose
+    )
+
+    return new_wvno_grid
+
+# In-memory cache of `photolysis_xs`
+_PHOTOLYSIS_CACHE = {}
+
+def photolysis_xs(data_dir, molecule, new_wvno_grid, cache_dir=None):
+    """Photolysis cross sections of a molecule interpolated to a wavenumber grid,
+    which are added to its line opacities. Results are cached in memory, and
+    in `cache_dir` if it is given.
+
+    Parameters
+    ----------
+    data_dir : str
+        Directory containing photolysis cross sections in `xsections/`.
+    molecule : str
+        Molecule name
+    new_wvno_grid : ndarray
+        Increasing wavenumber grid (cm^-1).
+    cache_dir : str, optional
+        Directory where the interpolated cross sections are saved, and reused
+        by later builds.
+
+    Returns
+    -------
+    ndarray or None
+        Cross sections in cm^2/molecule, or None if the molecule has no
+        photolysis cross sections.
+    """
+    filename = data_dir+'/xsections/'+molecule+'.h5'
+    if not os.path.exists(filename):
+        return None
+
+    h = file_hash(filename)
+    h.update(np.ascontiguousarray(new_wvno_grid, dtype=np.float64).tobytes())
+    # Earlier versions filled with 1e-200 instead of 0
+    h.update(b'fill=0')
+    key = h.hexdigest()
+    if key in _PHOTOLYSIS_CACHE:
+        return _PHOTOLYSIS_CACHE[key]
+
+    cache_file = None if cache_dir is None else os.path.join(cache_dir, 'photolysis_'+molecule+'_'+key+'.npy')
+    if cache_file is not None and os.path.exists(cache_file):
+        xs_new = np.load(cache_file)
+    else:
+        with h5py.File(filename,'r') as f:
+            xs = f['photoabsorption'][:].astype(np.float64)[::-1]
+            wno = 1e4/(f['wavelengths'][:].astype(np.float64)[::-1]/1e3)
+        # Zero outside of the cross sections, so clamped opacities stay at the floor
+        xs_new = np.interp(new_wvno_grid,wno,xs,left=0.0,right=0.0)
+        if cache_file is not None:
+            if not os.path.isdir(cache_dir):
+                os.mkdir(cache_dir)
+            np.save(cache_file, xs_new)
+
+    xs_new.flags.writeable = False
+    if len(_PHOTOLYSIS_CACHE) >= 64:
+        _PHOTOLYSIS_CACHE.pop(next(iter(_PHOTOLYSIS_CACHE)))
+    _PHOTOLYSIS_CACHE[key] = xs_new
+    return xs_new
+
+# Number of spectra of one temperature that are read and resampled together. Each
+# process holds a few float64 copies of this many full resolution spectra.
+SPECTRA_PER_BLOCK = 4
+
+def insert_molecule_targets(targets, molecule, data_dir, T, P, k, d_k=None, codec='npy', dtype=None, max_rel_error=None,
+                            chain=False, cache_dir=None, verbose=True, spectra_per_block=SPECTRA_PER_BLOCK):
+    """Insert molecule into several PICASO opacity DBs, reading each (T, P) 
+    spectrum from `k` only once, in blocks of `spectra_per_block` spectra.
+
+    Parameters
+    ----------
+    targets : list
+        List of (new_db, new_wvno_grid, operator) tuples, where `operator` is a 
+        `ResamplingOperator` onto `new_wvno_grid`. With `chain`, `new_db` can be None
+        for a target that is only resampled, as the source of the next one.
+    molecule : str
+        Molecule name
+    data_dir : str
+        Directory containing photolysis cross sections in `xsections/`.
+    T : ndarray
+        Array of temperatures in K
+    P : ndarray
+        Array of pressures in bar
+    k : ndarray
+        Opacities in cm^2/molecule. shape is `(len(T),len(P),nwno)`.
+    d_k : h5py.Dataset, optional
+        If given, `k` is also copied into this dataset (see `create_molecule_h5`).
+    codec : str
+        Blob codec for opacities, 'npy', 'raw' or 'log16' (see `opacity_codec`).
+    dtype : str, optional
+        dtype of the stored opacities. If None, then float64 is used.
+    max_rel_error : float, optional
+        Maximum relative error of the 'log16' codec.
+    chain : bool
+        If True, the operator of each target is applied to the resampled spectra of 
+        the previous target (before clamping and photolysis), instead of to `k`.
+    cache_dir : str, optional
+        Directory for cached photolysis cross sections (see `photolysis_xs`).
+    spectra_per_block : int
+        Number of spectra of a temperature that are resampled together, which
+        bounds the memory used.
+    """
+
+    writers = [
+        None if new_db is None else DBWriter(new_db, codec=codec, dtype=dtype, max_rel_error=max_rel_error) 
+        for new_db, _, _ in targets
+    ]
+
+    # Photolysis cross sections on each target grid
+    photolysis = [
+        None if new_db is None else photolysis_xs(data_dir, molecule, new_wvno_grid, cache_dir) 
+        for new_db, new_wvno_grid, _ in targets
+    ]
 
     for i in range(len(T)):
         if verbose:
             print('Temperature = %i'%(T[i]))
-        for j in range(len(P)):
-            l = j + i*len(P)
 
-            # Interpolate LBL opacity to a common grid
-            dset = np.interp(interp_wvno_grid, og_wvno_grid, k[i,j,:], right=1e-50, left=1e-50)
+        for j0 in range(0, len(P), spectra_per_block):
+            j1 = min(j0 + spectra_per_block, len(P))
 
-            # Make smallest number 1e-200
-            dset[dset<1e-200] = 1e-200 
+            # Read the opacities at a block of pressures for this temperature
+            block = np.asarray(k[i,j0:j1])
 
-            # Resample
-            y = dset[::bins]
+            if d_k is not None:
+                write_h5_opacities(d_k, (i, slice(j0, j1)), block)
 
-            # Add in photolysis cross sections
-            filename = data_dir+'/xsections/'+molecule+'.h5'
-            if os.path.exists(filename):
-                with h5py.File(filename,'r') as f:
-                    xs = f['photoabsorption'][:].astype(np.float64)[::-1]
-                    wno = 1e4/(f['wavelengths'][:].astype(np.float64)[::-1]/1e3)
-                y += np.interp(new_wvno_grid,wno,xs,left=1e-200,right=1e-200)
+            src = block
+            for (new_db, new_wvno_grid, operator), writer, xs in zip(targets, writers, photolysis):
 
-            cur.execute('INSERT INTO molecular (ptid, molecule, temperature, pressure,opacity) values (?,?,?,?,?)', (int(l),molecule,float(T[i]),float(P[j]), y))
-                
-    conn.commit()
-    cur.execute('SELECT pressure_unit from header')
-    p_find = cur.fetchall()
-    if len(p_find) == 0:
-        cur.execute('INSERT INTO header (pressure_unit, temperature_unit, wavenumber_grid, continuum_unit, molecular_unit) values (?,?,?,?,?)',
-                ('bar','kelvin', np.array(new_wvno_grid), 'cm-1 amagat-2', 'cm2/molecule'))
-        conn.commit()
-    conn.close()
+                # Resample
+                dset = operator.apply(src)
+                if writer is None:
+                    src = dset
+                    continue
+                if chain:
+                    src = dset.copy()
 
-    return new_wvno_grid
+                # Make smallest number 1e-200
+                clip_min(dset, 1e-200)
+
+                # Add in photolysis cross sections
+                if xs is not None:
+                    dset += xs
 
-def write_CIA_file(data_dir, filename):
+                for j in range(j0, j1):
+                    l = j + i*len(P)
+                    writer.add_molecular(l, molecule, T[i], P[j], dset[j-j0])
+
+    for (new_db, new_wvno_grid, operator), writer in zip(targets, writers):
+        if writer is not None:
+            writer.set_header(new_wvno_grid)
+            writer.close()
+
+def read_CIA_data(data_dir):
+    """Interpolates every CIA table in `data_dir/CIA` onto a common temperature and
+    wavenumber grid, and converts them to log10(cm^-1 amagat^-2).
+
+    Parameters
+    ----------
+    data_dir : str
+        Photochem data directory.
+
+    Returns
+    -------
+    temperatures : ndarray
+        Temperatures in K, shape (nT,)
+    wno : ndarray
+        Increasing wavenumbers in cm^-1, shape (nwno,)
+    log10xs : ndarray
+        CIA in log10(cm^-1 amagat^-2), shape (nT, nwno, len(molecules))
+    molecules : list
+        Names of the CIA pairs, e.g. 'N2N2'.
+    """
 
     cia_dir = data_dir+'/CIA'
     tmp = os.listdir(cia_dir)
     filenames = [a for a in tmp if '.h5' in a]
-    col_names = ['wno'] + [a.strip('.h5').replace('-','') for a in filenames]
+    molecules = [a.strip('.h5').replace('-','') for a in filenames]
+
+    wv_grid = np.logspace(np.log10(0.1), np.log10(250), 1000)
+    
+    T_grid = np.arange(40, 3000.0+.1, 20)
+
+    Pstp = 1
+    C = 1/1.013e6
+    Tstp = 273.15
+    k = 1.3807e-16
+    Ca = (Pstp*(1/C))/(k*Tstp)
+
+    # Increasing wavenumber
+    wv_grid = wv_grid[::-1]
+    wno = 1e4/wv_grid
 
-    wvs = []
-    Ts = []
-    xss = []
-    for file1 in filenames:
+    log10xs = np.empty((len(T_grid), len(wno), len(filenames)))
+    Tg, wvg = np.meshgrid(T_grid, wv_grid, indexing='ij', sparse=True)
+    for i,file1 in enumerate(filenames):
         with h5py.File(cia_dir + '/'+file1,'r') as f:
             
             # Zeros for high and lower wavelengths
             wv = f['wavelengths'][:]
             wv = np.concatenate((np.array([wv[0]*0.9999]),wv,np.array([wv[-1]*1.0001])))
-            wvs.append(wv)
     
             # Extrapolate to higher and lower T
             T = f['T'][:]
             T = np.concatenate((np.array([0]),T,np.array([10000])))
-            Ts.append(T)
     
             xs = f['log10xs'][:].T
             tmp = np.ones(xs.shape[0])*np.min(xs)
@@ -417,47 +1722,64 @@ def write_CIA_file(data_dir, filename):
             tmp1 = xs[0,:].reshape((1,len(wv)))
             tmp2 = xs[-1,:].reshape((1,len(wv)))
             xs = np.concatenate((tmp1,xs,tmp2),axis=0)
-            
-            xss.append(xs)
-    
-    wv_grid = np.logspace(np.log10(0.1), np.log10(250), 1000)
-    
-    T_grid = np.arange(40, 3000.0+.1, 20)
-    
-    xs_grids = []
-    for i in range(len(xss)):
-        xs = xss[i]
-        T = Ts[i]
-        wv = wvs[i]
-        f = interpolate.RegularGridInterpolator((T, wv), xs, bounds_error=False, fill_value=-153.82632446)
-        Tg, wvg = np.meshgrid(T_grid, wv_grid, indexing='ij', sparse=True)
-        xs_grid = f((Tg, wvg))
-        xs_grids.append(xs_grid)
-    
-    Pstp = 1
-    C = 1/1.013e6
-    Tstp = 273.15
-    k = 1.3807e-16
-    Ca = (Pstp*(1/C))/(k*Tstp)
-    
-    fmt = '{:>14}'
+
+        # Interpolate all temperatures and wavelengths at once
+        interp = interpolate.RegularGridInterpolator((T, wv), xs, bounds_error=False, fill_value=-153.82632446)
+        log10xs[:,:,i] = interp((Tg, wvg))
+
+    # Convert units
+    log10xs = np.log10((10.0**log10xs) * Ca**2)
+
+    return T_grid, wno, log10xs, molecules
+
+def write_CIA_file(data_dir, filename, cia_data=None):
+    """Writes the CIA data from `read_CIA_data` to a text file in the format read 
+    by `restruct_continuum`. This is only needed for debugging."""
+
+    if cia_data is None:
+        cia_data = read_CIA_data(data_dir)
+    temperatures, wno, log10xs, molecules = cia_data
+    col_names = ['wno'] + molecules
+
+    fmt = '%14.1f' + '%14.4f'*len(molecules)
     with open(filename,'w') as f:
-        f.write('%i %i\n'%(len(wv_grid),len(T_grid)))
-        for i in range(len(T_grid)):
-            f.write('%.1f\n'%(T_grid[i]))
-            for j in range(len(wv_grid)):
-                k = len(wv_grid) - j - 1
-                wno = 1e4/wv_grid[k]
-                f.write(fmt.format('%.1f'%wno))
-                for l in range(len(xs_grids)):
-                    xs_grid = xs_grids[l]
-                    xs = np.log10((10.0**xs_grid[i,k]) * Ca**2)
-                    f.write(fmt.format('%.4f'%xs))
-                f.write('\n')
+        f.write('%i %i\n'%(len(wno),len(temperatures)))
+        for i in range(len(temperatures)):
+            f.write('%.1f\n'%(temperatures[i]))
+            np.savetxt(f, np.concatenate((wno[:,None], log10xs[i]), axis=1), fmt=fmt)
 
     return col_names
 
-def restruct_continuum(original_file,colnames, new_wno,new_db, overwrite):
+def insert_continuum(new_db, data_dir, new_wno, cia_data=None, codec='npy', dtype=None, max_rel_error=None):
+    """Interpolates the CIA tables in `data_dir/CIA` to `new_wno`, and inserts 
+    them into the continuum table of `new_db`.
+
+    Parameters
+    ----------
+    new_db : str 
+        str of new database name
+    data_dir : str
+        Photochem data directory.
+    new_wno : ndarray
+        wavenumber grid to interpolate onto (units of inverse cm)
+    cia_data : tuple, optional
+        Output of `read_CIA_data`, if it has already been computed.
+    codec : str
+        Blob codec for opacities, 'npy', 'raw' or 'log16' (see `opacity_codec`).
+    dtype : str, optional
+        dtype of the stored opacities. If None, then float64 is used.
+    max_rel_error : float, optional
+        Maximum relative error of the 'log16' codec.
+    """
+    if cia_data is None:
+        cia_data = read_CIA_data(data_dir)
+    temperatures, old_wno, log10xs, molecules = cia_data
+    restructure_opacity(
+        new_db, len(temperatures), temperatures, molecules, log10xs, old_wno, new_wno,
+        codec=codec, dtype=dtype, max_rel_error=max_rel_error
+    )
+
+def restruct_continuum(original_file,colnames, new_wno,new_db, overwrite, codec='npy', dtype=None, max_rel_error=None):
     """
     The continuum factory takes the CIA opacity file and adds in extra sources of 
     opacity from other references to fill in empty bands. It assumes that the original file is 
@@ -487,14 +1809,22 @@ def restruct_continuum(original_file,colnames, new_wno,new_db, overwrite):
     overwrite : bool 
         Default is set to False as to not overwrite any existing files. This parameter controls overwriting 
         cia database 
+    codec : str
+        Blob codec for opacities, 'npy', 'raw' or 'log16' (see `opacity_codec`).
+    dtype : str, optional
+        dtype of the stored opacities. If None, then float64 is used.
+    max_rel_error : float, optional
+        Maximum relative error of the 'log16' codec.
     """
     og_opacity, temperatures, old_wno, molecules = get_original_data(original_file,
         colnames, overwrite=overwrite,new_db=new_db)
 
     ntemp = len(temperatures)
+    og_opacity = og_opacity[molecules].values.reshape((ntemp, len(old_wno), len(molecules)))
 
     #restructure and insert to database 
-    restructure_opacity(new_db,ntemp,temperatures,molecules,og_opacity,old_wno,new_wno)
+    restructure_opacity(new_db,ntemp,temperatures,molecules,og_opacity,old_wno,new_wno,codec=codec,dtype=dtype,
+                        max_rel_error=max_rel_error)
 
 def get_original_data(original_file,colnames,new_db, overwrite=False):
     """
@@ -525,7 +1855,7 @@ def get_original_data(original_file,colnames,new_db, overwrite=False):
         Default is set to False as to not overwrite any existing files. This parameter controls overwriting 
         cia database 
    """
-    og_opacity = pd.read_csv(original_file,delim_whitespace=True,names=colnames)
+    og_opacity = pd.read_csv(original_file,sep=r'\s+',names=colnames)
     
     temperatures = og_opacity['wno'].loc[np.isnan(og_opacity[colnames[1]])].values
 
@@ -544,11 +1874,8 @@ def get_original_data(original_file,colnames,new_db, overwrite=False):
 
     return og_opacity, temperatures, old_wno, molecules
 
-def insert(cur,conn,mol,T,opacity):
-    """Insert into """
-    cur.execute('INSERT INTO continuum (molecule, temperature, opacity) values (?,?,?)', (mol,float(T), opacity))
-
-def restructure_opacity(new_db,ntemp,temperatures,molecules,og_opacity,old_wno,new_wno):
+def restructure_opacity(new_db,ntemp,temperatures,molecules,og_opacity,old_wno,new_wno,codec='npy',dtype=None,
+                        max_rel_error=None,operator=None):
     """
     Parameters
     ----------
@@ -560,24 +1887,38 @@ def restructure_opacity(new_db,ntemp,temperatures,molecules,og_opacity,old_wno,n
         array of temperatures
     molecules : list
         list of molecules to put in database
-    og_opacity : pandas dataframe
-        pandas dataframe of original opacity
+    og_opacity : ndarray
+        log10 of the original opacity, shape (ntemp, len(old_wno), len(molecules))
     old_wno : array
         array of original wavenumbers
     new_wno : array
         array of new wavenumbers to interpolate onto
+    codec : str
+        Blob codec for opacities, 'npy', 'raw' or 'log16' (see `opacity_codec`).
+    dtype : str, optional
+        dtype of the stored opacities. If None, then float64 is used. When float32
+        is used, the interpolated opacities are also computed in float32.
+    max_rel_error : float, optional
+        Maximum relative error of the 'log16' codec.
+    operator : ResamplingOperator, optional
+        Precomputed 'point' operator from `old_wno` to `new_wno` with `fill=-33`,
+        which is applied to log10 of the opacities.
     """
 
-    cur, conn = open_local(new_db)
-    nwno = len(old_wno)
-    for i in range(ntemp): 
-        for m in molecules:
-            opa_bundle = og_opacity.iloc[ i*nwno : (i+1) * nwno][m].values
-            new_bundle = 10**(np.interp(new_wno,  old_wno, opa_bundle,right=-33,left=-33))
-            insert(cur, conn, m, temperatures[i], new_bundle)
-
-    conn.commit()
-    conn.close()
+    if operator is None:
+        operator = ResamplingOperator.build(old_wno, new_wno, 'point', fill=-33)
+
+    # Interpolate all molecules of one temperature at once, in log10 space, so
+    # only one temperature of the resampled opacities is in memory at a time
+    og_opacity = np.asarray(og_opacity)[:ntemp]
+    with DBWriter(new_db, codec=codec, dtype=dtype, max_rel_error=max_rel_error) as writer:
+        for i in range(ntemp): 
+            log10_bundles = operator.apply(og_opacity[i].T)
+            if dtype is not None:
+                log10_bundles = log10_bundles.astype(dtype)
+            new_bundles = 10.0**log10_bundles
+            for im,m in enumerate(molecules):
+                writer.add_continuum(m, temperatures[i], new_bundles[im])
 
 def download_photochem_data():
     github_username = 'Nicholaswogan'
@@ -594,31 +1935,28 @@ def download_photochem_data():
     
 if __name__ == '__main__':
 
+    import argparse
+    parser = argparse.ArgumentParser(description='Builds the PICASO opacity DBs and HDF5 files from HELIOS-K outputs.')
+    instrument.add_argument(parser)
+    parallel.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.setup(args)
+    parallel.setup(args)
+
     download_photochem_data()
 
-    # All wavelengths, low resolution.
-    make_db(
-        heliosk_dir='./', 
-        data_dir='photochem_clima_data/photochem_clima_data/data', 
-        min_wavelength=0.1, 
-        max_wavelength=250.0, 
-        new_R=15_000, 
-        old_R=1e6
-    )
-    # UV - NIR, high resolution
-    make_db(
+    # All wavelengths at low resolution, UV - NIR at high resolution,
+    # and the raw opacities as HDF5 files, from one read of the data.
+    make_dbs(
         heliosk_dir='./', 
         data_dir='photochem_clima_data/photochem_clima_data/data', 
-        min_wavelength=0.1, 
-        max_wavelength=5.5, 
-        new_R=60_000, 
-        old_R=1e6
-    )
-
-    resave_as_h5_files(
-        heliosk_dir='./', 
-        outdir='photochem_opacities'
+        targets=[
+            (0.1, 250.0, 15_000),
+            (0.1, 5.5, 60_000),
+        ],
+        old_R=1e6,
+        h5_outdir='photochem_opacities'
     )
     h5_files_readme(
         outdir='photochem_opacities'
-    )
\ No newline at end of file
+    )
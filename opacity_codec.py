@@ -0,0 +1,316 @@
+"""Encoding of the opacity arrays that are stored as blobs in the PICASO opacity
+databases written by `make_picaso_db.py`.
+
+Three codecs are supported:
+    1) 'npy': each blob is a complete `.npy` file written with `np.save`. This is
+       what PICASO expects, and is the default.
+    2) 'raw': each blob is the raw little-endian buffer of the array. The dtype
+       and length are recorded once in the `header` table, and blobs are decoded
+       with `np.frombuffer` without a copy.
+    3) 'log16': lossy. log10(k) is quantized to 16 bits with a per-spectrum offset
+       and scale, so that the relative error of every opacity is at most
+       `max_rel_error`, which is recorded in the `header` table. Each blob is the
+       offset and scale (two little-endian float64) followed by the uint16 levels.
+       Level 0 is reserved for opacities at or below `LOG16_FLOOR`, which are
+       decoded as `LOG16_FLOOR`, so they do not widen the quantized range.
+
+Databases can be converted between codecs with
+
+    python opacity_codec.py opacities.db --codec raw --dtype float32
+    python opacity_codec.py opacities.db --codec log16 --max-rel-error 0.005
+"""
+import numpy as np
+import io
+import sqlite3
+import argparse
+
+CODECS = ('npy', 'raw', 'log16')
+# Version 2 reserves level 0 of 'log16' for the floor
+CODEC_VERSION = 2
+
+# Columns added to the `header` table to describe the blobs
+HEADER_COLUMNS = (
+    ('codec', 'VARCHAR'),
+    ('codec_version', 'INTEGER'),
+    ('opacity_dtype', 'VARCHAR'),
+    ('opacity_length', 'INTEGER'),
+    ('max_rel_error', 'FLOAT'),
+)
+
+# Smallest opacity that the 'log16' codec represents, the same as the clamp in `make_picaso_db`
+LOG16_FLOOR = 1e-200
+LOG16_LEVELS = 2**16 - 1
+LOG16_DEFAULT_ERROR = 5e-3
+
+def quantize_log(arr, max_rel_error=LOG16_DEFAULT_ERROR, floor=LOG16_FLOOR):
+    """Quantizes log10(arr) to uint16 levels, separately along the last axis.
+
+    Values at or below `floor` get level 0. The other values are spread over
+    levels 1 to `LOG16_LEVELS`, between the smallest and largest of them, so
+    the floor does not count towards their range. Rounding to the nearest level 
+    has a log10 error of at most scale/2, so the relative error is at most 
+    `max_rel_error` when scale <= 2*log10(1 + max_rel_error).
+
+    Parameters
+    ----------
+    arr : ndarray
+        Values to quantize.
+    max_rel_error : float
+        Maximum allowed relative error of the decoded values above `floor`.
+    floor : float
+        Smallest value that is represented.
+
+    Returns
+    -------
+    q : ndarray
+        uint16 levels, the same shape as `arr`.
+    offset : ndarray
+        log10 of the values of level 0 (if it were not the floor), along the last axis.
+    scale : ndarray
+        Step in log10 between levels.
+    """
+    if not max_rel_error > 0:
+        raise ValueError('max_rel_error must be positive')
+    arr = np.asarray(arr, dtype=np.float64)
+    above = arr > floor
+    log10k = np.log10(np.where(above, arr, 1.0))
+    low = np.min(np.where(above, log10k, np.inf), axis=-1)
+    high = np.max(np.where(above, log10k, -np.inf), axis=-1)
+    # Spectra that are entirely at the floor
+    empty = ~np.any(above, axis=-1)
+    low = np.where(empty, np.log10(floor), low)
+    high = np.where(empty, np.log10(floor), high)
+    scale = (high - low)/(LOG16_LEVELS - 1)
+    # The small margin absorbs floating point error in the encode and decode
+    max_scale = 2*np.log10(1 + max_rel_error)*(1 - 1e-9)
+    if np.any(scale > max_scale):
+        raise ValueError('Opacities above %g span %.1f orders of magnitude, which can not be stored with 16 bits '
+                         'and a relative error of at most %g (the smallest possible is %.2g).'
+                         %(floor, np.max(scale)*(LOG16_LEVELS - 1), max_rel_error, 10.0**(np.max(scale)/2) - 1))
+    scale = np.where(scale > 0, scale, 1.0)
+    offset = low - scale
+    q = np.rint((log10k - offset[...,None])/scale[...,None])
+    q = np.where(above, np.clip(q, 1, LOG16_LEVELS), 0).astype(np.uint16)
+    return q, offset, scale
+
+def dequantize_log(q, offset, scale, floor=LOG16_FLOOR):
+    """Inverse of `quantize_log`."""
+    out = 10.0**(np.asarray(offset)[...,None] + q*np.asarray(scale)[...,None])
+    return np.where(q == 0, floor, out)
+
+def encode(arr, codec='npy', dtype=None, max_rel_error=None):
+    """Encodes an opacity array as a blob.
+
+    Parameters
+    ----------
+    arr : ndarray
+        1D array of opacities.
+    codec : str
+        One of 'npy', 'raw' or 'log16'.
+    dtype : str or np.dtype, optional
+        dtype to store. If None, then float64 is used. Ignored by 'log16'.
+    max_rel_error : float, optional
+        Maximum relative error for 'log16'. Default is `LOG16_DEFAULT_ERROR`.
+
+    Returns
+    -------
+    sqlite3.Binary
+    """
+    dtype = np.dtype('<f8' if dtype is None else dtype).newbyteorder('<')
+    arr = np.ascontiguousarray(arr, dtype=dtype)
+    if codec == 'npy':
+        out = io.BytesIO()
+        np.save(out, arr)
+        return sqlite3.Binary(out.getvalue())
+    elif codec == 'raw':
+        return sqlite3.Binary(arr.tobytes())
+    elif codec == 'log16':
+        if max_rel_error is None:
+            max_rel_error = LOG16_DEFAULT_ERROR
+        q, offset, scale = quantize_log(arr, max_rel_error)
+        return sqlite3.Binary(np.array([offset, scale], dtype='<f8').tobytes() + q.astype('<u2').tobytes())
+    else:
+        raise ValueError('codec must be one of '+', '.join(CODECS))
+
+def decode(blob, codec='npy', dtype=None):
+    """Decodes a blob written by `encode`. For the 'raw' codec, the result is a
+    read-only view of `blob`. For 'log16', the result is float64.
+    """
+    if codec == 'npy':
+        return np.load(io.BytesIO(blob))
+    elif codec == 'raw':
+        dtype = np.dtype('<f8' if dtype is None else dtype).newbyteorder('<')
+        return np.frombuffer(blob, dtype=dtype)
+    elif codec == 'log16':
+        offset, scale = np.frombuffer(blob, dtype='<f8', count=2)
+        return dequantize_log(np.frombuffer(blob, dtype='<u2', offset=16), offset, scale)
+    else:
+        raise ValueError('codec must be one of '+', '.join(CODECS))
+
+def blob_layout(prefix, codec='npy', dtype=None):
+    """Where the opacities start in the blobs of a database, so that a window of a
+    spectrum can be read with `substr` and decoded with `decode_slice`.
+
+    Parameters
+    ----------
+    prefix : bytes
+        The start of any blob of the database, including the whole header of a
+        '.npy' file for the 'npy' codec.
+    codec : str
+        One of 'npy', 'raw' or 'log16'.
+    dtype : str or np.dtype, optional
+        dtype recorded in the header table.
+
+    Returns
+    -------
+    offset : int
+        Byte offset of the first opacity.
+    item_dtype : np.dtype
+        dtype of each stored opacity.
+    """
+    if codec == 'npy':
+        f = io.BytesIO(prefix)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            _, fortran_order, item_dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            _, fortran_order, item_dtype = np.lib.format.read_array_header_2_0(f)
+        if item_dtype.hasobject:
+            raise ValueError('Blobs with object arrays can not be sliced')
+        return f.tell(), item_dtype
+    elif codec == 'raw':
+        return 0, np.dtype('<f8' if dtype is None else dtype).newbyteorder('<')
+    elif codec == 'log16':
+        return 16, np.dtype('<u2')
+    else:
+        raise ValueError('codec must be one of '+', '.join(CODECS))
+
+def decode_slice(data, codec, item_dtype, head=None):
+    """Decodes bytes of a blob that start at an opacity (see `blob_layout`).
+    For 'log16', `head` must be the first 16 bytes of the blob."""
+    arr = np.frombuffer(data, dtype=item_dtype)
+    if codec == 'log16':
+        offset, scale = np.frombuffer(head, dtype='<f8', count=2)
+        return dequantize_log(arr, offset, scale)
+    return arr
+
+def slice_blob(blob, codec, dtype, start, stop):
+    """Cuts a blob down to the opacities [start, stop). 'raw' and 'log16' blobs are
+    cut without decoding them, so the result is exactly the stored values.
+    """
+    if codec == 'npy':
+        arr = decode(blob, codec, dtype)[start:stop]
+        return encode(arr, codec, arr.dtype)
+    offset, item_dtype = blob_layout(b'', codec, dtype)
+    blob = bytes(blob)
+    return sqlite3.Binary(blob[:offset] + blob[offset+start*item_dtype.itemsize:offset+stop*item_dtype.itemsize])
+
+def read_codec(cur):
+    """Gets the codec and dtype of the blobs in a database from its `header` table.
+    Databases written before the codec columns existed use 'npy'.
+
+    Parameters
+    ----------
+    cur : sqlite3.Cursor
+        Cursor of the database
+
+    Returns
+    -------
+    codec : str
+    dtype : str or None
+    """
+    cur.execute('PRAGMA table_info(header)')
+    columns = [a[1] for a in cur.fetchall()]
+    if 'codec' not in columns:
+        return 'npy', None
+    cur.execute('SELECT codec, opacity_dtype, codec_version FROM header')
+    result = cur.fetchone()
+    if result is None or result[0] is None:
+        return 'npy', None
+    codec, dtype, version = result
+    if codec == 'log16' and version != CODEC_VERSION:
+        raise ValueError("'log16' blobs of codec version %s can not be decoded. "
+                         "The database must be rebuilt."%version)
+    return codec, dtype
+
+def read_max_rel_error(cur):
+    """Gets the maximum relative error of a database written with the 'log16' codec,
+    or None for lossless databases."""
+    cur.execute('PRAGMA table_info(header)')
+    columns = [a[1] for a in cur.fetchall()]
+    if 'max_rel_error' not in columns:
+        return None
+    cur.execute('SELECT max_rel_error FROM header')
+    result = cur.fetchone()
+    return None if result is None else result[0]
+
+def codec_dtype(codec, dtype=None):
+    """dtype string recorded in the `header` table for a codec."""
+    if codec == 'log16':
+        return np.dtype('<u2').str
+    return np.dtype('<f8' if dtype is None else dtype).newbyteorder('<').str
+
+def migrate(db_f, codec, dtype=None, batch_size=64, max_rel_error=None):
+    """Re-encodes all of the opacity blobs in a database in place.
+
+    Parameters
+    ----------
+    db_f : str
+        Database file name.
+    codec : str
+        New codec, one of 'npy', 'raw' or 'log16'.
+    dtype : str or np.dtype, optional
+        New dtype. If None, then float64 is used.
+    batch_size : int
+        Number of rows that are re-encoded at a time.
+    max_rel_error : float, optional
+        Maximum relative error for 'log16'. Default is `LOG16_DEFAULT_ERROR`.
+    """
+    if codec not in CODECS:
+        raise ValueError('codec must be one of '+', '.join(CODECS))
+    if codec == 'log16' and max_rel_error is None:
+        max_rel_error = LOG16_DEFAULT_ERROR
+    if codec != 'log16':
+        max_rel_error = None
+    conn = sqlite3.connect(db_f)
+    cur = conn.cursor()
+    old_codec, old_dtype = read_codec(cur)
+
+    # Add the codec columns to older databases
+    cur.execute('PRAGMA table_info(header)')
+    columns = [a[1] for a in cur.fetchall()]
+    for name, sqltype in HEADER_COLUMNS:
+        if name not in columns:
+            cur.execute('ALTER TABLE header ADD COLUMN %s %s'%(name, sqltype))
+
+    length = None
+    for table in ['molecular', 'continuum']:
+        ids = [a[0] for a in cur.execute('SELECT id FROM %s ORDER BY id'%table).fetchall()]
+        for i in range(0, len(ids), batch_size):
+            batch = ids[i:i+batch_size]
+            cur.execute('SELECT id, opacity FROM %s WHERE id IN (%s)'%(table, ','.join('?'*len(batch))), batch)
+            rows = []
+            for id_, blob in cur.fetchall():
+                arr = decode(blob, old_codec, old_dtype)
+                length = len(arr)
+                rows.append((encode(arr, codec, dtype, max_rel_error), id_))
+            cur.executemany('UPDATE %s SET opacity = ? WHERE id = ?'%table, rows)
+
+    cur.execute('UPDATE header SET codec = ?, codec_version = ?, opacity_dtype = ?, opacity_length = ?, max_rel_error = ?',
+                (codec, CODEC_VERSION, codec_dtype(codec, dtype), length, max_rel_error))
+    conn.commit()
+    cur.execute('VACUUM')
+    conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-encode the opacity blobs of a PICASO opacity DB.')
+    parser.add_argument('db', help='Database file name')
+    parser.add_argument('--codec', choices=CODECS, required=True)
+    parser.add_argument('--dtype', default=None, help='e.g. float32 or float64 (default)')
+    parser.add_argument('--max-rel-error', type=float, default=None, 
+                        help='Maximum relative error of the log16 codec (default %g)'%LOG16_DEFAULT_ERROR)
+    args = parser.parse_args()
+    migrate(args.db, args.codec, args.dtype, max_rel_error=args.max_rel_error)
+
+if __name__ == '__main__':
+    main()
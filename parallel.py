@@ -0,0 +1,111 @@
+"""Parallelism settings for the post-processing scripts.
+
+Two settings are used:
+
+- threads: the number of BLAS/OpenMP threads, and of numba threads used by
+  the `prange` kernels. The kernels give bit-identical results to the serial
+  NumPy code, which is used when threads = 1.
+- nprocs: the default number of worker processes of the process pools.
+
+They are set with the environment variables `PHOTOCHEM_THREADS` and
+`PHOTOCHEM_NPROCS`, or with `configure` (which the `--threads` and `--nprocs`
+flags of the scripts call). Both default to 1. Worker processes inherit them.
+
+Importing this module, or the scripts that use it, does not change any global
+state. Thread limits are only applied inside `limits`, or in worker
+processes with `set_limits`.
+
+Process pools are made with `executor`, which starts workers with 'spawn'.
+Forking a process whose numba (TBB) thread pool is running can hang it.
+"""
+import os
+import contextlib
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numba as nb
+from threadpoolctl import threadpool_limits
+
+THREADS_ENV_VAR = 'PHOTOCHEM_THREADS'
+NPROCS_ENV_VAR = 'PHOTOCHEM_NPROCS'
+
+def _read_env(name):
+    value = os.environ.get(name)
+    if not value:
+        return 1
+    n = int(value)
+    if n < 1:
+        raise ValueError('%s must be a positive integer, not %s'%(name, value))
+    return n
+
+def threads():
+    """Number of threads for BLAS and the numba kernels."""
+    return _read_env(THREADS_ENV_VAR)
+
+def nprocs():
+    """Default number of worker processes."""
+    return _read_env(NPROCS_ENV_VAR)
+
+def configure(threads=None, nprocs=None):
+    """Sets the number of threads and/or worker processes. Also sets the
+    environment variables, so worker processes use the same settings."""
+    for name, n in [(THREADS_ENV_VAR, threads), (NPROCS_ENV_VAR, nprocs)]:
+        if n is None:
+            continue
+        if int(n) < 1:
+            raise ValueError('%s must be a positive integer, not %s'%(name, n))
+        os.environ[name] = str(int(n))
+
+def _numba_threads(n):
+    return max(1, min(n, nb.config.NUMBA_NUM_THREADS))
+
+@contextlib.contextmanager
+def limits():
+    """Limits BLAS/OpenMP threads, and sets the numba threads, to `threads()`
+    inside a `with` block. The previous settings are restored afterwards."""
+    n = threads()
+    numba_threads = nb.get_num_threads()
+    nb.set_num_threads(_numba_threads(n))
+    try:
+        with threadpool_limits(limits=n):
+            yield n
+    finally:
+        nb.set_num_threads(numba_threads)
+
+def set_limits():
+    """Applies `threads()` for the rest of the process. Meant for the
+    initializer of worker processes."""
+    nb.set_num_threads(_numba_threads(threads()))
+    return threadpool_limits(limits=threads())
+
+def _init_worker(initializer, initargs):
+    set_limits()
+    if initializer is not None:
+        initializer(*initargs)
+
+def executor(max_workers, initializer=None, initargs=()):
+    """A `ProcessPoolExecutor` whose workers are spawned, and use `threads()`
+    threads (see `set_limits`). `initializer` must be picklable."""
+    return ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker, initargs=(initializer, initargs)
+    )
+
+def limited(fcn):
+    """Decorator that runs a function inside `limits`."""
+    @functools.wraps(fcn)
+    def wrapper(*args, **kwargs):
+        with limits():
+            return fcn(*args, **kwargs)
+    return wrapper
+
+def add_arguments(parser):
+    """Adds the `--threads` and `--nprocs` flags to an argparse parser."""
+    parser.add_argument('--threads', type=int, default=None, metavar='N',
+                        help='Number of BLAS and numba threads (same as setting %s=N)'%THREADS_ENV_VAR)
+    parser.add_argument('--nprocs', type=int, default=None, metavar='N',
+                        help='Number of worker processes (same as setting %s=N)'%NPROCS_ENV_VAR)
+
+def setup(args):
+    """Applies `--threads` and `--nprocs` if they were given."""
+    configure(threads=args.threads, nprocs=args.nprocs)
@@ -0,0 +1,139 @@
+"""Reader for the k-tables written by `make_photochem_ktable.py`.
+
+    kt = KTable('kdistributions/H2O.h5')
+    log10k = kt.log10k(T, P) # shape (len(T), len(kt.wavelengths)-1, len(kt.weights))
+
+The table is read once. `log10k` interpolates bilinearly in (T, log10(P)) for all
+layers, wavelength bins and g-points at once. The interpolation stencil of the
+last (T, P) profile is kept, so calling `log10k` again with the same profile (e.g.
+in every radiative transfer iteration) only does the weighted sum. A stencil
+can also be made once with `stencil` and passed in.
+"""
+import numpy as np
+import h5py
+from read_picaso_db import interpolation_stencil
+
+class KTableStencil():
+    """Corners and weights for interpolating a k-table to a (T, P) profile.
+    Made by `KTable.stencil`.
+
+    Parameters
+    ----------
+    T : ndarray
+        Temperatures in K.
+    P : ndarray
+        Pressures in bar.
+    corners : ndarray
+        Shape (4, len(T)). Flat (T, log10P) grid index of each corner.
+    weights : ndarray
+        Shape (4, len(T)). Weight of each corner.
+    """
+
+    def __init__(self, T, P, corners, weights):
+        self.T = T
+        self.P = P
+        self.corners = corners
+        self.weights = weights
+
+    def matches(self, T, P):
+        return np.array_equal(self.T, T) and np.array_equal(self.P, P)
+
+class KTable():
+    """A k-table from `make_photochem_ktable.create_k_dataset`.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the HDF5 file.
+
+    Attributes
+    ----------
+    species : str
+    notes : str
+    weights : ndarray
+        Widths of the g intervals.
+    T : ndarray
+        Temperature grid in K.
+    log10P : ndarray
+        log10 of the pressure grid in bar.
+    wavelengths : ndarray
+        Edges of the wavelength bins in microns.
+    """
+
+    def __init__(self, filename):
+        with h5py.File(filename, 'r') as f:
+            self.species = f['species'][()].decode().strip()
+            self.notes = f['notes'][()].decode().strip()
+            self.weights = f['weights'][:].astype(np.float64)
+            self.T = f['T'][:].astype(np.float64)
+            self.log10P = f['log10P'][:].astype(np.float64)
+            self.wavelengths = f['wavelengths'][:].astype(np.float64)
+            # Stored as (wavelength, T, log10P, g)
+            log10k = f['log10k'][:].astype(np.float64)
+        nw, nT, nP, ng = log10k.shape
+        self.shape = (nw, ng)
+        # One contiguous row of all wavelengths and g-points per (T, log10P) point
+        self._table = np.ascontiguousarray(log10k.transpose(1,2,0,3)).reshape((nT*nP, nw*ng))
+        self._stencil = None
+
+    def stencil(self, T, P):
+        """Precomputes the interpolation to a (T, P) profile. Points outside the
+        grid are clipped to its edges.
+
+        Parameters
+        ----------
+        T : ndarray
+            Temperatures in K.
+        P : ndarray
+            Pressures in bar, same shape as `T`.
+
+        Returns
+        -------
+        KTableStencil
+        """
+        T = np.atleast_1d(np.array(T, dtype=np.float64))
+        P = np.atleast_1d(np.array(P, dtype=np.float64))
+        if T.shape != P.shape or T.ndim != 1:
+            raise ValueError('T and P must be 1D arrays with the same shape')
+        nT, nP = len(self.T), len(self.log10P)
+        iT, wT = interpolation_stencil(T, self.T)
+        iP, wP = interpolation_stencil(np.log10(P), self.log10P)
+        iT1 = np.minimum(iT + 1, nT - 1)
+        iP1 = np.minimum(iP + 1, nP - 1)
+        corners = np.stack((iT*nP + iP, iT1*nP + iP, iT*nP + iP1, iT1*nP + iP1))
+        weights = np.stack(((1-wT)*(1-wP), wT*(1-wP), (1-wT)*wP, wT*wP))
+        return KTableStencil(T, P, corners, weights)
+
+    def log10k(self, T=None, P=None, stencil=None):
+        """Interpolates log10 of the k-coefficients to a (T, P) profile.
+
+        Parameters
+        ----------
+        T : ndarray, optional
+            Temperatures in K.
+        P : ndarray, optional
+            Pressures in bar, same shape as `T`.
+        stencil : KTableStencil, optional
+            Precomputed stencil from `stencil`, used instead of `T` and `P`.
+
+        Returns
+        -------
+        ndarray
+            log10 of the k-coefficients in cm^2/molecule, with shape
+            (len(T), len(self.wavelengths)-1, len(self.weights)).
+        """
+        if stencil is None:
+            if T is None or P is None:
+                raise ValueError('Either T and P, or stencil, must be given')
+            if self._stencil is None or not self._stencil.matches(T, P):
+                self._stencil = self.stencil(T, P)
+            stencil = self._stencil
+
+        out = stencil.weights[0][:,None]*self._table[stencil.corners[0]]
+        for c in range(1, 4):
+            out += stencil.weights[c][:,None]*self._table[stencil.corners[c]]
+        return out.reshape((out.shape[0],) + self.shape)
+
+    def k(self, T=None, P=None, stencil=None):
+        """The k-coefficients in cm^2/molecule. See `log10k`."""
+        return 10.0**self.log10k(T, P, stencil)
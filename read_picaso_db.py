@@ -0,0 +1,390 @@
+"""Readers for the opacities written by `make_picaso_db.py`, either the PICASO
+SQLite databases or the `photochem_opacities/*.h5` files.
+
+    with open_opacities('opacities_photochem_0.1_250.0_R15000.db') as r:
+        k = r.opacity('H2O', T, P) # shape (len(T), len(r.wno))
+
+The (T, P) grid of each molecule is read once. Spectra are decoded only when an
+interpolation needs them, and are kept in an LRU cache that is bounded by memory.
+Readers opened with `window=(min_wavelength, max_wavelength)` only read and decode
+the part of each spectrum inside the window.
+"""
+import numpy as np
+import os
+import io
+import sqlite3
+import collections
+import h5py
+import opacity_codec
+from wogan_data import grids as wogan_grids
+
+class SpectrumCache():
+    """LRU cache of decoded spectra, bounded by the number of bytes it holds.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Maximum total size of the cached arrays. Arrays larger than this are
+        never cached.
+    """
+
+    def __init__(self, max_bytes=2**30):
+        self.max_bytes = int(max_bytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key):
+        arr = self._data.get(key)
+        if arr is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return arr
+
+    def put(self, key, arr):
+        if arr.nbytes > self.max_bytes:
+            return
+        if key in self._data:
+            self.nbytes -= self._data.pop(key).nbytes
+        self._data[key] = arr
+        self.nbytes += arr.nbytes
+        while self.nbytes > self.max_bytes:
+            _, old = self._data.popitem(last=False)
+            self.nbytes -= old.nbytes
+
+    def clear(self):
+        self._data.clear()
+        self.nbytes = 0
+
+def interpolation_stencil(x, grid):
+    """Lower grid index and linear weight of the upper neighbour for each value
+    in `x`. Values outside the grid are clipped to its edges.
+
+    Parameters
+    ----------
+    x : ndarray
+        Points to interpolate to.
+    grid : ndarray
+        Increasing grid.
+
+    Returns
+    -------
+    i : ndarray
+        Index of the lower neighbour.
+    w : ndarray
+        Weight of `grid[i+1]`. The weight of `grid[i]` is `1 - w`.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    if len(grid) == 1:
+        return np.zeros(x.shape, dtype=np.intp), np.zeros(x.shape)
+    i = np.clip(np.searchsorted(grid, x, side='right') - 1, 0, len(grid) - 2)
+    w = np.clip((x - grid[i])/(grid[i+1] - grid[i]), 0.0, 1.0)
+    return i, w
+
+class OpacityReader():
+    """Base class of the readers. Subclasses implement `_read_grid` and `_read_spectra`.
+
+    Parameters
+    ----------
+    cache_bytes : int
+        Size limit of the LRU cache of decoded spectra, in bytes.
+    window : tuple, optional
+        (min_wavelength, max_wavelength) in microns. If given, only this part of
+        the spectra is read.
+    """
+
+    methods = ('linear', 'loglog')
+
+    def __init__(self, cache_bytes=2**30, window=None):
+        self.cache = SpectrumCache(cache_bytes)
+        self.window = window
+        self._grids = {}
+
+    def _set_wavenumbers(self, wno):
+        """Sets `self.wno`, and the indices [start, stop) of the window in `wno`."""
+        if self.window is None:
+            self.start, self.stop = 0, len(wno)
+        else:
+            self.start, self.stop = wogan_grids.window_indices(wno, *self.window)
+        self.wno = wno[self.start:self.stop]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        pass
+
+    def grid(self, molecule):
+        """Temperature (K) and pressure (bar) grid of a molecule.
+
+        Returns
+        -------
+        T : ndarray
+        P : ndarray
+        """
+        if molecule not in self._grids:
+            self._grids[molecule] = self._read_grid(molecule)
+        T, P, _ = self._grids[molecule]
+        return T, P
+
+    def spectra(self, molecule, iT, iP):
+        """Opacities (cm^2/molecule) at grid points (T[iT], P[iP]) of a molecule.
+
+        Parameters
+        ----------
+        molecule : str
+            Molecule name
+        iT : ndarray
+            Temperature indices.
+        iP : ndarray
+            Pressure indices, same shape as `iT`.
+
+        Returns
+        -------
+        ndarray
+            Shape (len(iT), len(self.wno)).
+        """
+        self.grid(molecule)
+        keys = self._grids[molecule][2][np.asarray(iT), np.asarray(iP)].ravel()
+        out = np.empty((len(keys), len(self.wno)))
+        missing = []
+        for i, key in enumerate(keys):
+            arr = self.cache.get((molecule, key))
+            if arr is None:
+                missing.append(i)
+            else:
+                out[i] = arr
+        if len(missing) > 0:
+            unique = sorted(set(int(keys[i]) for i in missing))
+            read = dict(zip(unique, self._read_spectra(molecule, unique)))
+            for i in missing:
+                out[i] = read[int(keys[i])]
+            # The cache is only an optimisation. Spectra larger than it, or
+            # evicted by the ones after them, are not needed from it.
+            for key, arr in read.items():
+                self.cache.put((molecule, key), arr)
+        return out
+
+    def opacity(self, molecule, T, P, method='loglog'):
+        """Interpolates the opacities of a molecule to arrays of temperatures and pressures.
+
+        Both methods interpolate bilinearly in log10(P). With 'linear', k is
+        interpolated linearly in T. With 'loglog', log10(k) is interpolated linearly
+        in log10(T). Points outside the grid are clipped to its edges.
+
+        Parameters
+        ----------
+        molecule : str
+            Molecule name
+        T : ndarray
+            Temperatures in K.
+        P : ndarray
+            Pressures in bar, same shape as `T`.
+        method : str
+            'linear' or 'loglog'.
+
+        Returns
+        -------
+        ndarray
+            Opacities in cm^2/molecule, shape (len(T), len(self.wno)).
+        """
+        if method not in self.methods:
+            raise ValueError('method must be one of '+', '.join(self.methods))
+        T = np.atleast_1d(np.asarray(T, dtype=np.float64))
+        P = np.atleast_1d(np.asarray(P, dtype=np.float64))
+        if T.shape != P.shape:
+            raise ValueError('T and P must have the same shape')
+        T_grid, P_grid = self.grid(molecule)
+
+        if method == 'loglog':
+            iT, wT = interpolation_stencil(np.log10(T), np.log10(T_grid))
+        else:
+            iT, wT = interpolation_stencil(T, T_grid)
+        iP, wP = interpolation_stencil(np.log10(P), np.log10(P_grid))
+        iT1 = np.minimum(iT + 1, len(T_grid) - 1)
+        iP1 = np.minimum(iP + 1, len(P_grid) - 1)
+
+        # Decode every corner that the layers need only once
+        corners_T = np.concatenate((iT, iT1, iT, iT1))
+        corners_P = np.concatenate((iP, iP, iP1, iP1))
+        flat = corners_T*len(P_grid) + corners_P
+        unique, inverse = np.unique(flat, return_inverse=True)
+        k = self.spectra(molecule, unique//len(P_grid), unique % len(P_grid))
+        if method == 'loglog':
+            k = np.log10(np.maximum(k, 1e-200))
+
+        n = len(T)
+        inverse = inverse.reshape(4, n)
+        weights = ((1-wT)*(1-wP), wT*(1-wP), (1-wT)*wP, wT*wP)
+        out = np.zeros((n, k.shape[1]))
+        for c in range(4):
+            out += weights[c][:,None]*k[inverse[c]]
+        if method == 'loglog':
+            out = 10.0**out
+        return out
+
+    def _read_grid(self, molecule):
+        """Returns T, P and an integer array of shape (len(T), len(P)) of the keys
+        that `_read_spectra` uses to find each spectrum."""
+        raise NotImplementedError()
+
+    def _read_spectra(self, molecule, keys):
+        """Returns a list of float64 spectra, one for each key."""
+        raise NotImplementedError()
+
+class PicasoDBReader(OpacityReader):
+    """Reads the `molecular` table of a PICASO opacity database, or of one level
+    of a pyramid database (see `make_picaso_db.make_pyramid`).
+
+    Parameters
+    ----------
+    db_f : str
+        Database file name.
+    cache_bytes : int
+        Size limit of the LRU cache of decoded spectra, in bytes.
+    level : int, optional
+        Level to read from a pyramid database. Default is 0, the finest level.
+    window : tuple, optional
+        (min_wavelength, max_wavelength) in microns. Only the bytes of each blob
+        inside the window are returned by SQLite and decoded.
+    """
+
+    def __init__(self, db_f, cache_bytes=2**30, level=None, window=None):
+        super().__init__(cache_bytes, window)
+        self.conn = sqlite3.connect(db_f)
+        self.cur = self.conn.cursor()
+        self.codec, self.dtype = opacity_codec.read_codec(self.cur)
+        self.max_rel_error = opacity_codec.read_max_rel_error(self.cur)
+
+        self.cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='levels'")
+        if self.cur.fetchone() is None:
+            if level is not None:
+                raise ValueError(db_f+' is not a pyramid database')
+            self.level = None
+            self._where = 'molecule = ?'
+            self.cur.execute('SELECT wavenumber_grid FROM header')
+        else:
+            self.level = 0 if level is None else int(level)
+            self._where = 'molecule = ? AND level = %i'%self.level
+            self.cur.execute('SELECT wavenumber_grid FROM levels WHERE level = ?', (self.level,))
+        result = self.cur.fetchone()
+        if result is None:
+            raise ValueError('%s has no level %i'%(db_f, self.level))
+        self._set_wavenumbers(np.load(io.BytesIO(result[0])))
+        self.cur.execute('SELECT DISTINCT molecule FROM molecular')
+        self.molecules = sorted(a[0] for a in self.cur.fetchall())
+
+        # Byte range of the window in every blob
+        self.cur.execute('SELECT opacity FROM molecular LIMIT 1')
+        result = self.cur.fetchone()
+        if result is not None:
+            offset, self._item_dtype = opacity_codec.blob_layout(bytes(result[0]), self.codec, self.dtype)
+            self._substr = (offset + self.start*self._item_dtype.itemsize + 1, 
+                            (self.stop - self.start)*self._item_dtype.itemsize)
+
+    def close(self):
+        self.conn.close()
+
+    def _read_grid(self, molecule):
+        self.cur.execute('SELECT ptid, temperature, pressure FROM molecular WHERE '+self._where, (molecule,))
+        rows = np.array(self.cur.fetchall(), dtype=np.float64)
+        if len(rows) == 0:
+            raise KeyError(molecule+' is not in the database')
+        T = np.unique(rows[:,1])
+        P = np.unique(rows[:,2])
+        if len(rows) != len(T)*len(P):
+            raise ValueError('The opacities of '+molecule+' are not on a rectangular (T, P) grid')
+        keys = np.empty((len(T), len(P)), dtype=np.int64)
+        keys[np.searchsorted(T, rows[:,1]), np.searchsorted(P, rows[:,2])] = rows[:,0].astype(np.int64)
+        return T, P, keys
+
+    def _read_spectra(self, molecule, keys):
+        self.cur.execute('SELECT ptid, substr(opacity, 1, 16), substr(opacity, ?, ?) FROM molecular WHERE %s AND ptid IN (%s)'
+                         %(self._where, ','.join('?'*len(keys))), list(self._substr) + [molecule] + list(keys))
+        spectra = {
+            ptid: opacity_codec.decode_slice(data, self.codec, self._item_dtype, head) 
+            for ptid, head, data in self.cur.fetchall()
+        }
+        return [np.asarray(spectra[key], dtype=np.float64) for key in keys]
+
+class H5Reader(OpacityReader):
+    """Reads the `<molecule>.h5` files written by `make_picaso_db.resave_as_h5_files`.
+
+    Parameters
+    ----------
+    h5_dir : str
+        Directory containing `wavenumber_grid.h5` and a file for each molecule.
+    cache_bytes : int
+        Size limit of the LRU cache of decoded spectra, in bytes.
+    window : tuple, optional
+        (min_wavelength, max_wavelength) in microns. Only the chunks that overlap the
+        window are read, so files written with `layout='window'` are best for this.
+    """
+
+    def __init__(self, h5_dir, cache_bytes=2**30, window=None):
+        super().__init__(cache_bytes, window)
+        self.h5_dir = h5_dir
+        with h5py.File(os.path.join(h5_dir,'wavenumber_grid.h5'),'r') as f:
+            self._set_wavenumbers(f['wno'][:].astype(np.float64))
+        self.molecules = sorted(a[:-3] for a in os.listdir(h5_dir) if a.endswith('.h5') and a != 'wavenumber_grid.h5')
+        self._files = {}
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+    def _file(self, molecule):
+        if molecule not in self._files:
+            filename = os.path.join(self.h5_dir, molecule+'.h5')
+            if not os.path.exists(filename):
+                raise KeyError(molecule+' is not in '+self.h5_dir)
+            self._files[molecule] = h5py.File(filename,'r')
+        return self._files[molecule]
+
+    def _read_grid(self, molecule):
+        f = self._file(molecule)
+        T = f['T'][:].astype(np.float64)
+        P = f['P'][:].astype(np.float64)
+        # Temperatures are stored in the order HELIOS-K computed them
+        iT = np.argsort(T)
+        iP = np.argsort(P)
+        if np.any(np.diff(T[iT]) <= 0) or np.any(np.diff(P[iP]) <= 0):
+            raise ValueError('The (T, P) grid of '+molecule+' has repeated values')
+        keys = iT[:,None]*len(P) + iP[None,:]
+        return T[iT], P[iP], keys
+
+    def _read_spectra(self, molecule, keys):
+        f = self._file(molecule)
+        d_k = f['k']
+        nP = d_k.shape[1]
+        # Each chunk holds one (T, P) spectrum (see `make_picaso_db.h5_chunk_shape`)
+        spectra = [d_k[key//nP, key % nP, self.start:self.stop] for key in keys]
+        if 'max_rel_error' not in d_k.attrs:
+            return [a.astype(np.float64) for a in spectra]
+        offset = f['k_offset'][:]
+        scale = f['k_scale'][:]
+        return [
+            opacity_codec.dequantize_log(a, offset[key//nP, key % nP], scale[key//nP, key % nP]) 
+            for key, a in zip(keys, spectra)
+        ]
+
+def open_opacities(path, cache_bytes=2**30, level=None, window=None):
+    """Opens a PICASO database (a file) or a directory of HDF5 files. `level` selects
+    a level of a pyramid database, and `window` is a (min_wavelength, max_wavelength)
+    range in microns."""
+    if os.path.isdir(path):
+        return H5Reader(path, cache_bytes, window)
+    return PicasoDBReader(path, cache_bytes, level, window)
@@ -1,7 +1,9 @@
 import subprocess
 from wogan_data.bins import T_grid
 import os
+import time
 import numpy as np
+from wogan_data import manifest as wogan_manifest
 from wogan_data import preprocess
 import hitran2
 
@@ -9,13 +11,25 @@ import hitran2
 
 def run(species, param_file):
 
+    manifest = wogan_manifest.read_manifest('.', species)
+
     found = False
-    if 'Out_'+species+'_bin0000.dat' in os.listdir('.'):
+    if manifest is not None and len(manifest['T']) > 0:
+        T_done = np.array(manifest['T'])
+        found = True
+    elif 'Out_'+species+'_bin0000.dat' in os.listdir('.'):
         results = np.loadtxt('Out_'+species+'_bin0000.dat')
+        T_done = np.unique(results[:,2])
         found = True
 
+    if manifest is None:
+        manifest = wogan_manifest.new_manifest(species, param_file)
+        if found:
+            # Runs from before manifests existed
+            manifest['T'] = list(T_done)
+
     if found:
-        T_max = np.max(results[:,2])
+        T_max = np.max(T_done)
         ind = np.argmin(np.abs(T_grid-T_max))
         TT = T_grid[ind+1:]
     else:
@@ -32,9 +46,14 @@ def run(species, param_file):
             for line in lines:
                 f.write(line)
 
+        t0 = time.time()
         res = subprocess.run("./heliosk")
         assert res.returncode == 0
 
+        # Record the completed temperature
+        wogan_manifest.add_temperature(manifest, T, time.time() - t0)
+        wogan_manifest.write_manifest('.', species, manifest)
+
 def run_all(): 
     # Preprocessing scripts
     hitran2.main()
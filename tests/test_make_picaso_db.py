@@ -0,0 +1,49 @@
+import os
+import sys
+import sqlite3
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import make_picaso_db
+import opacity_codec
+
+def test_log16_with_photolysis_keeps_the_floor(tmp_path):
+    src_wno = np.linspace(1000.0, 20000.0, 4000)
+    new_wno = np.linspace(1100.0, 19000.0, 1000)
+    T = np.array([100.0, 200.0])
+    P = np.array([0.01, 1.0])
+
+    # Line opacities that are clamped below ~8000 cm^-1
+    rng = np.random.default_rng(0)
+    k = 10.0**rng.uniform(-30.0, -20.0, size=(len(T), len(P), len(src_wno)))
+    k[:,:,src_wno < 8000.0] = 0.0
+
+    # Photolysis cross sections between 0.5 and 0.9 um
+    os.mkdir(tmp_path/'xsections')
+    with h5py.File(tmp_path/'xsections'/'SP0.h5', 'w') as f:
+        wavelengths = np.linspace(500.0, 900.0, 50)
+        f['wavelengths'] = wavelengths
+        f['photoabsorption'] = np.full(len(wavelengths), 1e-19)
+
+    db_f = str(tmp_path/'log16.db')
+    make_picaso_db.build_skeleton(db_f)
+    operator = make_picaso_db.ResamplingOperator.build(src_wno, new_wno, 'point')
+    make_picaso_db.insert_molecule_targets(
+        [(db_f, new_wno, operator)], 'SP0', str(tmp_path), T, P, k,
+        codec='log16', max_rel_error=1e-3, verbose=False
+    )
+
+    conn = sqlite3.connect(db_f)
+    rows = conn.execute('SELECT ptid, opacity FROM molecular ORDER BY ptid').fetchall()
+    conn.close()
+    assert len(rows) == len(T)*len(P)
+    xs = make_picaso_db.photolysis_xs(str(tmp_path), 'SP0', new_wno)
+    for ptid, blob in rows:
+        expected = operator.apply(k[ptid//len(P), ptid % len(P)][None,:])[0]
+        expected = np.maximum(expected, opacity_codec.LOG16_FLOOR) + xs
+        out = opacity_codec.decode(blob, 'log16')
+        floor = expected <= opacity_codec.LOG16_FLOOR
+        assert np.any(floor)
+        assert np.all(out[floor] == opacity_codec.LOG16_FLOOR)
+        assert np.max(np.abs(out[~floor]/expected[~floor] - 1)) <= 1e-3
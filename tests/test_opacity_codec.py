@@ -0,0 +1,50 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import opacity_codec
+
+def spectra_with_floor():
+    rng = np.random.default_rng(0)
+    # 17 orders of magnitude above the floor, with clamped and zero opacities
+    k = 10.0**rng.uniform(-35.0, -18.0, size=(4, 1000))
+    k[:,:100] = opacity_codec.LOG16_FLOOR
+    k[:,100:110] = 0.0
+    return k
+
+@pytest.mark.parametrize('max_rel_error', [1e-3, 5e-4])
+def test_log16_floor_does_not_count_towards_range(max_rel_error):
+    k = spectra_with_floor()
+    q, offset, scale = opacity_codec.quantize_log(k, max_rel_error)
+    out = opacity_codec.dequantize_log(q, offset, scale)
+
+    above = k > opacity_codec.LOG16_FLOOR
+    assert np.all(q[~above] == 0)
+    assert np.all(out[~above] == opacity_codec.LOG16_FLOOR)
+    assert np.max(np.abs(out[above]/k[above] - 1)) <= max_rel_error
+
+def test_log16_blob_roundtrip():
+    k = spectra_with_floor()[0]
+    blob = opacity_codec.encode(k, 'log16', max_rel_error=1e-3)
+    out = opacity_codec.decode(blob, 'log16')
+    above = k > opacity_codec.LOG16_FLOOR
+    assert np.max(np.abs(out[above]/k[above] - 1)) <= 1e-3
+    assert np.all(out[~above] == opacity_codec.LOG16_FLOOR)
+
+    # A window that starts in the floor is decoded the same way
+    window = opacity_codec.slice_blob(blob, 'log16', None, 50, 200)
+    assert np.array_equal(opacity_codec.decode(window, 'log16'), out[50:200])
+
+def test_log16_constant_and_empty_spectra():
+    k = np.array([[3e-20]*10, [0.0]*10])
+    q, offset, scale = opacity_codec.quantize_log(k, 1e-4)
+    out = opacity_codec.dequantize_log(q, offset, scale)
+    assert np.allclose(out[0], 3e-20, rtol=1e-4)
+    assert np.all(out[1] == opacity_codec.LOG16_FLOOR)
+
+def test_log16_range_too_large():
+    k = np.array([1e-150, 1e-18])
+    with pytest.raises(ValueError):
+        opacity_codec.quantize_log(k, 1e-3)
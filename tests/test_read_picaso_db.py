@@ -0,0 +1,42 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import make_picaso_db
+import read_picaso_db
+
+def make_synthetic_db(db_f, T, P, nwno):
+    wno = np.linspace(1000.0, 2000.0, nwno)
+    k = {}
+    make_picaso_db.build_skeleton(db_f)
+    with make_picaso_db.DBWriter(db_f) as writer:
+        writer.set_header(wno)
+        for i in range(len(T)):
+            for j in range(len(P)):
+                k[i,j] = 10.0**(-20 - i - j + np.sin(wno/50.0))
+                writer.add_molecular(j + i*len(P), 'SP0', T[i], P[j], k[i,j])
+    return k
+
+def test_opacity_with_cache_smaller_than_one_call(tmp_path):
+    T = np.array([100.0, 150.0, 200.0])
+    P = np.array([0.01, 0.1, 1.0])
+    nwno = 500
+    db_f = str(tmp_path/'synthetic.db')
+    k = make_synthetic_db(db_f, T, P, nwno)
+
+    T_layers = [110.0, 120.0, 150.0]
+    P_layers = [0.5, 0.05, 0.1]
+    with read_picaso_db.open_opacities(db_f) as r:
+        expected = r.opacity('SP0', T_layers, P_layers)
+    assert np.all(np.isfinite(expected))
+    assert np.allclose(expected[2], k[1,1], rtol=1e-12)
+
+    # No spectrum fits in the cache, or the corners of one call do not
+    for cache_bytes in [0, 3*nwno*8]:
+        with read_picaso_db.open_opacities(db_f, cache_bytes=cache_bytes) as r:
+            for method in r.methods:
+                with read_picaso_db.open_opacities(db_f) as ref:
+                    assert np.array_equal(r.opacity('SP0', T_layers, P_layers, method), 
+                                          ref.opacity('SP0', T_layers, P_layers, method))
+            assert r.cache.nbytes <= cache_bytes
@@ -0,0 +1,166 @@
+import numpy as np
+import os
+import functools
+from wogan_data import bins
+
+# Number of wavenumbers in each interval of bins.wavnum ("Nnu per bin" in param.dat)
+NNU_PER_BIN = 100_000
+
+# Directory containing this file, and the param.dat_<species> files
+WOGAN_DATA_DIR = os.path.dirname(os.path.realpath(__file__))
+
+@functools.lru_cache(maxsize=4)
+def _heliosk_wavenumbers(edges, nnu_per_bin):
+    edges = np.array(edges)
+    start = edges[:-1]
+    step = (edges[1:] - start)/nnu_per_bin
+    # Same operations as np.linspace(start, stop, nnu_per_bin+1)[:-1] for each interval
+    wno = (np.arange(nnu_per_bin)[None,:]*step[:,None] + start[:,None]).ravel()
+    wno.flags.writeable = False
+    return wno
+
+def heliosk_wavenumbers(nnu_per_bin=NNU_PER_BIN, wavnum=None):
+    """Wavenumber grid of the full spectra written by HELIOS-K (doStoreFullK = 2)
+    when it is run with binsFile = bins.txt and "Nnu per bin" points in each bin.
+
+    Parameters
+    ----------
+    nnu_per_bin : int
+        Number of wavenumbers in each bin.
+    wavnum : ndarray, optional
+        Bin edges in cm^-1. Default is `bins.wavnum`.
+
+    Returns
+    -------
+    ndarray
+        Read-only, increasing wavenumber grid in cm^-1. The result is memoized.
+    """
+    if wavnum is None:
+        wavnum = bins.wavnum
+    edges = np.sort(np.asarray(wavnum, dtype=np.float64))
+    return _heliosk_wavenumbers(tuple(edges), int(nnu_per_bin))
+
+@functools.lru_cache(maxsize=8)
+def _constant_R_grid(min_wavelength, max_wavelength, constant_R):
+    spacing = (2.*constant_R+1.)/(2.*constant_R-1.)
+    npts = np.log(max_wavelength/min_wavelength)/np.log(spacing)
+    wsize = int(np.ceil(npts))+1
+    # cumprod multiplies sequentially, so this matches newwl[j] = newwl[j-1]*spacing
+    factors = np.full(wsize, spacing)
+    factors[0] = min_wavelength
+    newwl = np.cumprod(factors)
+    wno = 1e4/newwl[::-1]
+    wno.flags.writeable = False
+    return wno
+
+def constant_R_grid(min_wavelength, max_wavelength, constant_R):
+    """Wavenumber grid defined with a constant R.
+
+    Parameters
+    ----------
+    min_wavelength : float
+        Minimum wavelength in microns
+    max_wavelength : float
+        Maximum wavelength in microns
+    constant_R : float
+        Constant R spacing
+
+    Returns
+    -------
+    ndarray
+        Read-only, increasing wavenumber grid in cm^-1. The result is memoized.
+    """
+    return _constant_R_grid(float(min_wavelength), float(max_wavelength), float(constant_R))
+
+def window_indices(wno, min_wavelength, max_wavelength):
+    """Indices [start, stop) of the increasing wavenumber grid `wno` (cm^-1) that are
+    inside a wavelength window.
+
+    Parameters
+    ----------
+    wno : ndarray
+        Increasing wavenumber grid in cm^-1.
+    min_wavelength : float
+        Minimum wavelength in microns
+    max_wavelength : float
+        Maximum wavelength in microns
+
+    Returns
+    -------
+    start : int
+    stop : int
+    """
+    if not 0 < min_wavelength < max_wavelength:
+        raise ValueError('The window must have 0 < min_wavelength < max_wavelength')
+    start = int(np.searchsorted(wno, 1e4/max_wavelength, side='left'))
+    stop = int(np.searchsorted(wno, 1e4/min_wavelength, side='right'))
+    if stop <= start:
+        raise ValueError('No wavenumbers between %g and %g microns'%(min_wavelength, max_wavelength))
+    return start, stop
+
+def load_or_save(filename, fcn, *args):
+    """Loads a grid from the `.npy` file `filename` if it exists. Otherwise, the
+    grid is built with `fcn(*args)` and saved to `filename`.
+    """
+    if os.path.exists(filename):
+        return np.load(filename)
+    grid = fcn(*args)
+    np.save(filename, grid)
+    return grid
+
+def read_param_file(filename):
+    """Reads a HELIOS-K param.dat file into a dictionary of strings."""
+    params = {}
+    with open(filename,'r') as f:
+        for line in f:
+            if '=' in line:
+                key, value = line.split('=',1)
+                params[key.strip()] = value.strip()
+    return params
+
+def check_param_file(filename, nnu_per_bin=NNU_PER_BIN, wavnum=None):
+    """Checks that a HELIOS-K param.dat file produces full spectra on the grid
+    given by `heliosk_wavenumbers(nnu_per_bin, wavnum)`.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the param.dat file.
+    nnu_per_bin : int
+        Number of wavenumbers in each bin assumed by the post-processing.
+    wavnum : ndarray, optional
+        Bin edges in cm^-1 assumed by the post-processing. Default is `bins.wavnum`.
+
+    Returns
+    -------
+    dict
+        The parameters in the file.
+    """
+    if wavnum is None:
+        wavnum = bins.wavnum
+    params = read_param_file(filename)
+
+    nnu = int(params['Nnu per bin'])
+    if nnu == 0:
+        raise ValueError(filename+' has "Nnu per bin = 0", so HELIOS-K uses dnu = '+params['dnu']
+                         +' instead of %i points per bin.'%nnu_per_bin)
+    if nnu != nnu_per_bin:
+        raise ValueError(filename+' has "Nnu per bin = %i", but %i is assumed.'%(nnu, nnu_per_bin))
+
+    bins_file = params['binsFile']
+    if not os.path.isabs(bins_file):
+        bins_file = os.path.join(WOGAN_DATA_DIR, '..', bins_file)
+    edges = np.loadtxt(bins_file)
+    if len(edges) != len(wavnum) or not np.allclose(np.sort(edges), np.sort(wavnum)):
+        raise ValueError(params['binsFile']+' does not match the assumed bin edges.')
+
+    return params
+
+def check_species_params(species, nnu_per_bin=NNU_PER_BIN, wavnum=None):
+    """Runs `check_param_file` on wogan_data/<species>/param.dat_<species>, if
+    the file exists. Returns the parameters, or None if there is no file.
+    """
+    filename = os.path.join(WOGAN_DATA_DIR, species, 'param.dat_'+species)
+    if not os.path.exists(filename):
+        return None
+    return check_param_file(filename, nnu_per_bin, wavnum)
@@ -0,0 +1,80 @@
+import numpy as np
+import os
+import json
+from wogan_data import bins
+from wogan_data import grids
+
+# Settings from param.dat that are recorded in the manifest
+PARAM_KEYS = ['dnu', 'Nnu per bin', 'binsFile', 'PFile', 'cutMode', 'cut', 'profile', 'doStoreFullK', 'doStoreSK']
+
+def manifest_filename(heliosk_dir, species):
+    return os.path.join(heliosk_dir, 'Manifest_'+species+'.json')
+
+def read_manifest(heliosk_dir, species):
+    """Reads the manifest written by `run_heliosk.run`, or returns None if
+    there is no manifest for `species`."""
+    filename = manifest_filename(heliosk_dir, species)
+    if not os.path.exists(filename):
+        return None
+    with open(filename,'r') as f:
+        return json.load(f)
+
+def write_manifest(heliosk_dir, species, manifest):
+    """Writes a manifest. The file is replaced atomically, so an interrupted run
+    never leaves a partially written manifest."""
+    filename = manifest_filename(heliosk_dir, species)
+    with open(filename+'.tmp','w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(filename+'.tmp', filename)
+
+def new_manifest(species, param_file):
+    """Creates an empty manifest with the settings in `param_file`."""
+    params = grids.read_param_file(param_file)
+    return {
+        'species': species,
+        'param_file': param_file,
+        'params': {key: params.get(key) for key in PARAM_KEYS},
+        'P': list(bins.P_grid),
+        'T': [],
+        'timings': [],
+    }
+
+def add_temperature(manifest, T, seconds):
+    """Records that HELIOS-K finished temperature `T` in `seconds`."""
+    manifest['T'].append(float(T))
+    manifest['timings'].append({'T': float(T), 'seconds': float(seconds)})
+
+def check_manifest(manifest, filename, nwno):
+    """Checks that a manifest is consistent with the grid assumed by the
+    post-processing, and with the size of the `Out_<species>.bin` file.
+
+    Parameters
+    ----------
+    manifest : dict
+        Manifest from `read_manifest`.
+    filename : str
+        Path to `Out_<species>.bin`.
+    nwno : int
+        Number of wavenumbers in each spectrum.
+
+    Returns
+    -------
+    T : ndarray
+        The temperatures that were completed, in the order they appear in `filename`.
+    """
+    species = manifest['species']
+    P = np.array(manifest['P'])
+    if len(P) != len(bins.P_grid) or not np.allclose(P, bins.P_grid):
+        raise ValueError('Manifest P grid for '+species+' does not match P_grid.')
+
+    nnu = manifest['params']['Nnu per bin']
+    if nnu is not None and int(nnu) != grids.NNU_PER_BIN:
+        raise ValueError('Manifest for '+species+' has "Nnu per bin = %s", but %i is assumed.'%(nnu, grids.NNU_PER_BIN))
+
+    T = np.array(manifest['T'])
+    nbytes = os.path.getsize(filename)
+    expected = len(T)*len(P)*nwno*np.dtype(np.float32).itemsize
+    if nbytes != expected:
+        raise ValueError('%s has %i bytes, but the manifest lists %i completed temperatures (%i bytes). '
+                         'The run is partial or mismatched.'%(filename, nbytes, len(T), expected))
+    return T